@@ -6,16 +6,17 @@ from flask_login import LoginManager
 from story_creator import init_db  # Import the database initialization function
 from story_creator.database_handler import get_user_by_email  # Import from the new database handler
 import datetime  # Import datetime module
+import time
 
 # Import blueprints
 from blueprints.auth import auth_bp
 from blueprints.main import main_bp
 
-import time
-
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
     app.secret_key = os.environ.get("FLASK_SECRET_KEY") # Replace with a secure key or load from environment variables
+    if config:
+        app.config.update(config)
 
     # Initialize Flask-Login
     login_manager = LoginManager()
@@ -24,20 +25,29 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(user_email):
-        time.sleep(1)
         return get_user_by_email(user_email)
 
     # Register blueprints
     app.register_blueprint(auth_bp)
     app.register_blueprint(main_bp)
 
-    # Context processor to inject 'current_year' into templates
+    # Context processor to inject 'current_year' into templates.
+    # The year is cached and only recomputed once an hour.
+    year_cache = {'year': datetime.datetime.utcnow().year, 'checked_at': time.monotonic()}
+
     @app.context_processor
     def inject_current_year():
-        return {'current_year': datetime.datetime.utcnow().year}
-
-    # Initialize the database (moved to story_creator package)
-    init_db()
+        now = time.monotonic()
+        if now - year_cache['checked_at'] > 3600:
+            year_cache['year'] = datetime.datetime.utcnow().year
+            year_cache['checked_at'] = now
+        return {'current_year': year_cache['year']}
+
+    # Initialize the database (moved to story_creator package).
+    # Skipped when the caller has already set up the database, e.g. in tests.
+    if not app.config.get('DB_INITIALIZED'):
+        init_db()
+        app.config['DB_INITIALIZED'] = True
 
     return app
 
@@ -7,11 +7,13 @@ This module handles user authentication routes such as login, logout,
 and login with token.
 """
 
-from flask import Blueprint, render_template, redirect, url_for, request, flash, session
+from flask import Blueprint, render_template, redirect, url_for, request, flash, session, current_app
 from flask_login import login_user, logout_user, login_required, current_user
 from itsdangerous import URLSafeTimedSerializer
 import smtplib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -20,8 +22,24 @@ from story_creator.database_handler import get_user_by_email, create_user, get_u
 
 auth_bp = Blueprint('auth', __name__)
 
-# Initialize serializer for generating tokens
-serializer = URLSafeTimedSerializer(os.environ.get("FLASK_SECRET_KEY"))  # Should match the app's secret key
+def get_serializer():
+    """Return the app's token serializer, creating it on first use.
+
+    The serializer is signed with the app's secret key and kept in app.extensions
+    so it is built once per app instead of at import time.
+    """
+    serializer = current_app.extensions.get('login_serializer')
+    if serializer is None:
+        serializer = URLSafeTimedSerializer(current_app.secret_key)
+        current_app.extensions['login_serializer'] = serializer
+    return serializer
+
+# Login emails are sent in the background so the login request does not wait on SMTP
+email_executor = ThreadPoolExecutor(max_workers=4)
+
+# One authenticated SMTP connection is kept open and shared by all sends
+smtp_connection = None
+smtp_lock = threading.Lock()
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -34,7 +52,7 @@ def login():
             return redirect(url_for('auth.login'))
 
         # Generate a token
-        token = serializer.dumps(email, salt='login')
+        token = get_serializer().dumps(email, salt='login')
 
         # Send the email with the token
         send_login_email(email, token)
@@ -49,7 +67,7 @@ def login_with_token(token):
     """Login with token route."""
     try:
         # The token expires after 1 hour (3600 seconds)
-        email = serializer.loads(token, salt='login', max_age=3600)
+        email = get_serializer().loads(token, salt='login', max_age=3600)
     except Exception as e:
         flash('The login link is invalid or has expired.')
         return redirect(url_for('auth.login'))
@@ -72,8 +90,13 @@ def logout():
     return redirect(url_for('main.index'))
 
 def send_login_email(email, token):
-    """Send login email with the login link."""
+    """Send login email with the login link in a background thread."""
+    # url_for needs the request context, so resolve the link before handing off
     login_link = url_for('auth.login_with_token', token=token, _external=True)
+    email_executor.submit(_send_login_email_sync, email, login_link)
+
+def _send_login_email_sync(email, login_link):
+    """Build and send the login email via SMTP."""
     subject = "Your Login Link for TaleVortex"
     body = f"""Hello,
 
@@ -107,17 +130,48 @@ TaleVortex Team"""
     msg['To'] = email
     msg.attach(MIMEText(body, 'plain'))
 
-    try:
-        # Send the email via SMTP server
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USERNAME, SMTP_PASSWORD)
-        server.sendmail(SMTP_USERNAME, email, msg.as_string())
-        server.quit()
-    except Exception as e:
-        print(f"Error sending email: {e}")
-        print(f'Email Address: {email}')
-        print(f'Secure Link: {login_link}')
+    with smtp_lock:
+        try:
+            # Send the email via the shared SMTP connection
+            server = get_smtp_connection(SMTP_SERVER, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD)
+            server.sendmail(SMTP_USERNAME, email, msg.as_string())
+        except Exception as e:
+            # Drop the connection so the next send starts with a fresh one
+            close_smtp_connection()
+            print(f"Error sending email: {e}")
+            print(f'Email Address: {email}')
+            print(f'Secure Link: {login_link}')
+
+def get_smtp_connection(host, port, username, password):
+    """Return the shared SMTP connection, reconnecting if it has gone stale.
+
+    Must be called while holding smtp_lock.
+    """
+    global smtp_connection
+    if smtp_connection is not None:
+        try:
+            status = smtp_connection.noop()[0]
+        except smtplib.SMTPException:
+            status = -1
+        if status == 250:
+            return smtp_connection
+        close_smtp_connection()
+
+    server = smtplib.SMTP(host, port)
+    server.starttls()
+    server.login(username, password)
+    smtp_connection = server
+    return server
+
+def close_smtp_connection():
+    """Close and forget the shared SMTP connection. Must be called while holding smtp_lock."""
+    global smtp_connection
+    if smtp_connection is not None:
+        try:
+            smtp_connection.quit()
+        except Exception:
+            pass
+        smtp_connection = None
 
 # blueprints/auth.py
 
@@ -7,65 +7,70 @@ This module handles the main routes for the application, including
 the index page, creating stories, selecting stories, adding and editing units, etc.
 """
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, abort, send_file, make_response
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, abort, send_file, g, Response
 from flask_login import login_required, current_user
-from werkzeug.datastructures import MultiDict
+import copy
+import hashlib
+import io
 import json
-import os
-import tempfile
+import re
+import threading
 import warnings
 import random
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from story_creator.openai_api_call import call_openai
 
 
 # Import service functions from the story_creator package
 from story_creator.database_handler import (
-    get_stories_by_user_email,
+    get_story_summaries_by_user_email,
     create_story,
     get_story_by_id,
+    get_story_for_user,
     add_unit_to_story,
-    get_unit_by_name,
-    update_unit,
-    get_units_by_story_id,
     update_references_with_new_unit,
-    update_story,
-    create_label,
-    assign_labels_to_units,
+    create_label_for_units,
     get_labels_by_user,
     get_units_by_labels,
     get_all_units_with_labels,
     get_unit_by_id,
     get_all_labels,
     get_units_by_label_filters,
-    delete_unit_from_story
+    delete_unit_from_story,
+    DuplicateNameError
 )
 
 # Import necessary unit subclasses
-from story_creator.new_models import Unit
+from story_creator.new_models import UNIT_TYPE_TO_CLASS
 
 main_bp = Blueprint('main', __name__)
 
+# Number of units shown per page in the 'All Units' list on the index page
+UNITS_PER_PAGE = 50
+
+# Matches the comma separated tokens of a unit id list that consist only of digits
+UNIT_IDS_PATTERN = re.compile(r'(?<![^,])\d+(?![^,])')
+
+
 def unit_classes_dict_helper():
     """Helper function to get a dictionary of Unit subclasses."""
-    return {cls.__name__: cls for cls in Unit.__subclasses__()}
+    return UNIT_TYPE_TO_CLASS
 
 
 @main_bp.route('/')
 def index():
     """Index route: Display user's stories, units, and handle unit labels."""
     if current_user.is_authenticated:
-        # Get user stories using the service layer
-        user_stories = get_stories_by_user_email(current_user.email)
+        # Only the names of the stories are listed, so their units are not loaded
+        user_stories = get_story_summaries_by_user_email(current_user.email)
         selected_story_id = session.get('current_story_id')
         selected_story = None
         if selected_story_id is not None:
-            selected_story = get_story_by_id(selected_story_id)
+            selected_story = get_story_for_user(selected_story_id, current_user.email)
         unit_classes_dict = unit_classes_dict_helper()
 
-        # Get all units with labels
-        all_units = get_all_units_with_labels()
-
         # Get user's labels
         all_labels = get_all_labels()
 
@@ -73,12 +78,21 @@ def index():
         selected_label_ids = request.args.getlist('label_ids', type=int)
         exclude_label_ids = request.args.getlist('exclude_label_ids', type=int)
         search_query = request.args.get('search_query', '').strip()
+        page = max(request.args.get('page', 1, type=int), 1)
 
+        # Fetch one extra unit to find out whether there is a next page
+        limit = UNITS_PER_PAGE + 1
+        offset = (page - 1) * UNITS_PER_PAGE
         if selected_label_ids or exclude_label_ids or search_query:
             # Filter units based on selected labels and search query
-            filtered_units = get_units_by_label_filters(selected_label_ids, exclude_label_ids, search_query)
+            filtered_units = get_units_by_label_filters(
+                selected_label_ids, exclude_label_ids, search_query, limit=limit, offset=offset
+            )
         else:
-            filtered_units = all_units
+            # Get all units with their labels (loaded in the same query)
+            filtered_units = get_all_units_with_labels(limit=limit, offset=offset)
+        has_next_page = len(filtered_units) > UNITS_PER_PAGE
+        filtered_units = filtered_units[:UNITS_PER_PAGE]
 
         return render_template(
             'index.html',
@@ -89,7 +103,9 @@ def index():
             labels=all_labels,
             selected_label_ids=selected_label_ids,
             exclude_label_ids=exclude_label_ids,  # Ensure you pass this to retain the selected excludes
-            search_query=search_query
+            search_query=search_query,
+            page=page,
+            has_next_page=has_next_page
         )
     else:
         return redirect(url_for('auth.login'))
@@ -104,8 +120,8 @@ def add_existing_unit(unit_id):
         flash("Please select a story first.")
         return redirect(url_for('main.index'))
 
-    story = get_story_by_id(story_id)
-    if story is None or story.user_email != current_user.email:
+    story = get_story_for_user(story_id, current_user.email)
+    if story is None:
         abort(403)
 
     unit = get_unit_by_id(unit_id)
@@ -113,14 +129,6 @@ def add_existing_unit(unit_id):
         abort(404, description="Unit not found.")
 
     if action == 'add':
-        # Check for duplicate names in the same story
-        name = unit.name.strip()
-        existing_unit = get_unit_by_name(story_id, name)
-        if existing_unit:
-            flash(f"ERROR: A unit with the name '{name}' already exists in this story.")
-            # errors.append(f"A unit with the name '{name}' already exists in this story.")
-            return redirect(url_for('main.index'))
-
         # Create a new unit with the same features
         new_unit = type(unit)(
             unit_type=unit.unit_type,
@@ -128,9 +136,14 @@ def add_existing_unit(unit_id):
             story_id=story_id,
             features=unit.features.copy()
         )
-        # Add the new unit to the story with is_copy=True and user_email
-        add_unit_to_story(story_id, new_unit, user_email=current_user.email, is_copy=True)
-        update_references_with_new_unit(new_unit, story)
+        # Add the new unit to the story with is_copy=True and user_email, updating
+        # the story's undefined names in the same transaction
+        try:
+            add_unit_to_story(story_id, new_unit, user_email=current_user.email, is_copy=True, story=story)
+        except DuplicateNameError as e:
+            flash(f"ERROR: {e}")
+            return redirect(url_for('main.index'))
+        schedule_story_pdf_prerender(story_id)
         flash(f"Unit '{unit.name}' has been added to your story.")
         return redirect(url_for('main.index'))
     elif action == 'use_as_template':
@@ -149,7 +162,7 @@ def add_existing_unit(unit_id):
 def assign_labels():
     """Assign labels to selected units."""
     unit_ids_str = request.form.get('unit_ids', '')
-    unit_ids = [int(uid) for uid in unit_ids_str.split(',') if uid.isdigit()]
+    unit_ids = list(map(int, UNIT_IDS_PATTERN.findall(unit_ids_str)))
     label_name = request.form.get('label_name', '').strip()
 
     if not unit_ids:
@@ -160,11 +173,8 @@ def assign_labels():
         flash("Please enter a label name.")
         return redirect(url_for('main.index'))
 
-    # Create the label
-    label_id = create_label(label_name, current_user.email)
-
-    # Assign the labels to units
-    assign_labels_to_units([label_id], unit_ids)
+    # Create the label and assign it to the units
+    create_label_for_units(label_name, current_user.email, unit_ids)
 
     flash(f"Label '{label_name}' has been assigned to selected units.")
     return redirect(url_for('main.index'))
@@ -193,19 +203,17 @@ def create_story_route():
                 flash(error)
             return render_template('create_story.html')
 
-        # Check for duplicate story name for the user
-        user_stories = get_stories_by_user_email(current_user.email)
-        if any(s.name == story_name for s in user_stories):
-            flash(f"A story with the name '{story_name}' already exists.")
+        # Create the Story using the service layer (story names are unique per user)
+        try:
+            story = create_story(
+                name=story_name,
+                user_email=current_user.email,
+                setting_and_style=setting_and_style,
+                main_challenge=main_challenge
+            )
+        except DuplicateNameError as e:
+            flash(str(e))
             return render_template('create_story.html')
-
-        # Create the Story using the service layer
-        story = create_story(
-            name=story_name,
-            user_email=current_user.email,
-            setting_and_style=setting_and_style,
-            main_challenge=main_challenge
-        )
         session['current_story_id'] = story.id
         flash(f"Story '{story_name}' has been created.")
         return redirect(url_for('main.index'))
@@ -279,378 +287,242 @@ def create_story_route():
 @login_required
 def select_story(story_id):
     """Route to select a story."""
-    story = get_story_by_id(story_id)
-    if story is None:
-        abort(404, description="Story not found.")
-    if story.user_email != current_user.email:
-        abort(403)
+    story = load_story_or_abort(story_id)
     session['current_story_id'] = story.id
     flash(f"Story '{story.name}' has been selected.")
     return redirect(url_for('main.index'))
 
 
+# Value shown in the unit form for a field without a value, by field type
+FIELD_DEFAULTS = {'list': [], 'str': '', 'bool': False, 'float': 0., 'int': 0}
+
+
 def clean_form_data(form_data, fields):
+    """Collect the unit form values from a MultiDict for re-rendering the form.
+
+    List fields keep all of their values, every other field its first value.
+    Missing values are replaced by a default for the field type.
+    """
+    cleaned = {}
+    if 'unit_description' in form_data:
+        cleaned['unit_description'] = form_data.get('unit_description')
     for field in fields:
         for name in [field.get('name'), f"{field.get('name')}_new"]:
-            if form_data.get(name) not in [None, [], '', ['']]:
-                if isinstance(form_data.get(name), list):
-                    form_data[name] = form_data.get(name)[0]
-                else:
-                    form_data[name] = form_data.get(name)
-                    warnings.warn(f"Value in form_data not of type list: {name} : {form_data.get(name)}")
+            if field.get('type') == 'list' and not name.endswith('_new'):
+                value = form_data.getlist(name)
             else:
-                warnings.warn("When you see this, something is wrong")
-                if name.endswith('_new'):
-                    form_data[name] = ''
-                elif field.get('type') == 'list':
-                    form_data[name] = []
-                elif field.get('type') == 'str':
-                    form_data[name] = ''
-                elif field.get('type') == 'bool':
-                    form_data[name] = False
-                elif field.get('type') == 'float':
-                    form_data[name] = 0.
-                elif field.get('type') == 'int':
-                    form_data[name] = 0
-                else:
-                    warnings.warn("When you see this, something is double wrong")
-    return form_data
+                value = form_data.get(name)
+            if value not in [None, [], '', ['']]:
+                cleaned[name] = value
+            elif name.endswith('_new'):
+                cleaned[name] = ''
+            else:
+                cleaned[name] = copy.copy(FIELD_DEFAULTS.get(field.get('type'), ''))
+    return cleaned
 
 
 @main_bp.route('/story/<int:story_id>/add_unit/<unit_type>', methods=['GET', 'POST'])
 @login_required
 def add_unit(story_id, unit_type):
     """Route to add a unit to a story."""
-    story = get_story_by_id(story_id)
-    if story is None:
-        abort(404, description="Story not found.")
-    if story.user_email != current_user.email:
-        abort(403)
+    story = load_story_or_abort(story_id)
 
     unit_classes = unit_classes_dict_helper()
     if unit_type not in unit_classes:
         return "Invalid unit type", 400
 
-    unit_class = unit_classes[unit_type]
-    feature_schema = unit_class.feature_schema
+    return handle_unit_form(story, unit_classes[unit_type], unit_type)
 
-    fields = prepare_fields(feature_schema, story)
+@main_bp.route('/story/<int:story_id>/edit_unit/<unit_name>', methods=['GET', 'POST'])
+@login_required
+def edit_unit(story_id, unit_name):
+    """Route to edit an existing unit."""
+    story = load_story_or_abort(story_id)
+
+    unit = story.get_unit(unit_name)
+    if not unit:
+        abort(404, description="Unit not found.")
+
+    return handle_unit_form(story, type(unit), unit.unit_type, unit=unit)
+
+
+def load_story_or_abort(story_id):
+    """Retrieve a story owned by the current user, aborting with 404 otherwise.
+
+    The story is cached on flask.g so it is loaded at most once per request.
+    """
+    story_cache = g.setdefault('_story_cache', {})
+    story = story_cache.get(story_id)
+    if story is None:
+        story = get_story_for_user(story_id, current_user.email)
+        if story is None:
+            abort(404, description="Story not found.")
+        story_cache[story_id] = story
+    return story
+
+
+def render_unit_form(story, unit_type, feature_schema, form_data, errors, edit_mode, fields=None):
+    """Render the add/edit unit form."""
+    if fields is None:
+        fields = prepare_fields(feature_schema, story)
+    return render_template(
+        'add_unit.html',
+        unit_type=unit_type,
+        fields=fields,
+        errors=errors,
+        form_data=form_data,
+        story=story,
+        edit_mode=edit_mode
+    )
+
+
+def handle_unit_form(story, unit_class, unit_type, unit=None):
+    """Handle the unit form shared by the add and edit routes.
+
+    Args:
+        story (Story): The story the unit belongs to.
+        unit_class (type): The Unit subclass of the unit.
+        unit_type (str): The type of the unit.
+        unit (Unit, optional): The unit being edited, or None when adding a new unit.
+    """
+    feature_schema = unit_class.feature_schema
+    edit_mode = unit is not None
 
     if request.method == 'POST':
         action = request.form.get('action')
-        form_data = request.form.to_dict(flat=False)
-
         if action == 'fill_features':
-            # Handle the OpenAI API call
-            description = form_data.get('unit_description', [''])[0].strip()
-            if description == '':
-                description = form_data.get('name', [''])[0].strip()
-            if not description:  # this ifclause should now never be called
-                warnings.warn('When you see this, something is wrong')
-                errors = ["Please provide a description to fill features."]
-                fields = prepare_fields(feature_schema, story)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=errors,
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=False
-                )
-            try:
-                # Generate the prompt messages
-                messages = feature_value_prefill_prompt(story, unit_type, description, feature_schema)
-                # Call OpenAI API
-                response_text = call_openai(messages)
-                # Parse the JSON response
-                feature_values = json.loads(response_text)
-                # Update form_data with feature_values
-                for key, value in feature_values.items():
-                    # Ensure the key is one of the features
-                    if key in feature_schema:
-                        if isinstance(value, list):
-                            form_data[key] = value
-                        else:
-                            form_data[key] = [str(value)]
-                        form_data[key] = value
-                for key, value in form_data.items():
-                    if ((key in feature_schema.keys() and feature_schema[key] != list)
-                        or key.endswith('_new')) and isinstance(value, list)\
-                            or key == 'unit_description':
-                        if len(value) > 1:
-                            raise ValueError("Expected at most one item in the list.")
-                        form_data[key] = value[0]
-                    # elif feature_schema[key] != list: raise ValueError("Unexpected form element")
-                # Re-render the form with updated form_data
-                fields = prepare_fields(feature_schema, story)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=[],
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=False
-                )
-            except json.JSONDecodeError as e:
-                errors = [f"Failed to parse AI response: {str(e)}", "AI response: " + response_text]
-                fields = prepare_fields(feature_schema, story)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=errors,
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=False
-                )
-            except Exception as e:
-                errors = [f"An error occurred while filling features: {str(e)}"]
-                fields = prepare_fields(feature_schema, story)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=errors,
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=False
-                )
+            return fill_unit_features(story, unit_type, feature_schema, edit_mode)
         elif action == 'save_unit':
-            # Process form submission
-            features, errors = process_form_submission(form_data, feature_schema, story)
-
-            # Validate 'name' field
-            name = features.get('name', '').strip()
-            if not name:
-                errors.append("Name is required.")
-            else:
-                # Check for duplicate names in the same story
-                existing_unit = get_unit_by_name(story_id, name)
-                if existing_unit:
-                    errors.append(f"A unit with the name '{name}' already exists in this story.")
-
-            if errors:
-                # Re-render the form with error messages
-                fields = prepare_fields(feature_schema, story)
-                form_data = clean_form_data(form_data, fields)
-
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=errors,
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=False
-                )
-            else:
-                # Create the Unit and add to the database
-                features['name'] = name
-                unit = unit_class(unit_type=unit_type, name=name, features=features, story_id=story.id)
-                add_unit_to_story(story_id, unit, user_email=current_user.email, is_copy=False)
-
-                # After adding the unit, update references if needed
-                update_references_with_new_unit(unit, story, old_name=unit.name)
-                flash(f"{unit_type} '{name}' has been added.")
-                return redirect(url_for('main.index'))
+            return save_unit(story, unit_class, unit_type, unit)
         else:
             raise Exception('submitted with unknown action.')
-    elif request.method == 'GET':
-        # GET request, render form
-        fields = prepare_fields(feature_schema, story)
+
+    # GET request, render form
+    fields = prepare_fields(feature_schema, story)
+    # Stored features already have their final types, so they are rendered as they are
+    if edit_mode:
+        # Prefill with the existing unit's data
+        form_data = unit.features
+    else:
         # Check for template data in session
         template_unit = session.pop('template_unit', None)
         if template_unit and template_unit.get('unit_type') == unit_type:
-            form_data = MultiDict(template_unit.get('features'))
+            form_data = template_unit.get('features')
         else:
-            form_data = MultiDict()
-        return render_template(
-            'add_unit.html',
-            unit_type=unit_type,
-            fields=fields,
-            errors=[],
-            form_data=form_data,
-            story=story,
-            edit_mode=False
-        )
+            form_data = {}
+    return render_unit_form(story, unit_type, feature_schema, form_data, [], edit_mode, fields=fields)
 
-@main_bp.route('/story/<int:story_id>/edit_unit/<unit_name>', methods=['GET', 'POST'])
-@login_required
-def edit_unit(story_id, unit_name):
-    # TODO: There is an error when a user edits an object that falsely does not include all unit references by default.
-    # Instead for each reference feature only the first unit is chosen by default.
-    """Route to edit an existing unit."""
-    story = get_story_by_id(story_id)
-    if story is None:
-        abort(404, description="Story not found.")
-    if story.user_email != current_user.email:
-        abort(403)
 
-    unit = get_unit_by_name(story_id, unit_name)
-    if not unit:
-        abort(404, description="Unit not found.")
+def fill_unit_features(story, unit_type, feature_schema, edit_mode):
+    """Prefill the unit form with feature values suggested by the OpenAI API."""
+    fields = prepare_fields(feature_schema, story)
+    form_data = clean_form_data(request.form, fields)
+    description = request.form.get('unit_description', '').strip()
+    if description == '':
+        description = request.form.get('name', '').strip()
+    if not description:  # this ifclause should now never be called
+        warnings.warn('When you see this, something is wrong')
+        errors = ["Please provide a description to fill features."]
+        return render_unit_form(story, unit_type, feature_schema, form_data, errors, edit_mode, fields=fields)
+    try:
+        # Generate the prompt messages
+        messages = feature_value_prefill_prompt(story, unit_type, description, feature_schema)
+        # Call OpenAI API; every fill asks again, so the user can get different values
+        response_text = call_openai(messages)
+        # Parse the JSON response
+        feature_values = json.loads(response_text)
+        # Update form_data with feature_values
+        for key, value in feature_values.items():
+            # Ensure the key is one of the features
+            if key in feature_schema:
+                # Single value features take at most one item if the answer is a list
+                if feature_schema[key] != list and isinstance(value, list):
+                    if len(value) > 1:
+                        raise ValueError("Expected at most one item in the list.")
+                    value = value[0] if value else ''
+                form_data[key] = value
+        # Re-render the form with updated form_data
+        return render_unit_form(story, unit_type, feature_schema, form_data, [], edit_mode, fields=fields)
+    except json.JSONDecodeError as e:
+        errors = [f"Failed to parse AI response: {str(e)}", "AI response: " + response_text]
+        return render_unit_form(story, unit_type, feature_schema, form_data, errors, edit_mode, fields=fields)
+    except Exception as e:
+        errors = [f"An error occurred while filling features: {str(e)}"]
+        return render_unit_form(story, unit_type, feature_schema, form_data, errors, edit_mode, fields=fields)
 
-    unit_class = type(unit)
-    unit_type = unit.unit_type
-    feature_schema = unit_class.feature_schema
 
-    if request.method == 'POST':
-        action = request.form.get('action')
-        form_data = request.form.to_dict(flat=False)
+def save_unit(story, unit_class, unit_type, unit=None):
+    """Validate the submitted unit form and create or update the unit."""
+    feature_schema = unit_class.feature_schema
+    edit_mode = unit is not None
 
-        if action == 'fill_features':
-            # Handle the OpenAI API call
-            description = form_data.get('unit_description', [''])[0].strip()
-            if description == '':
-                description = form_data.get('name', [''])[0].strip()
-            if not description:  # this ifclause should now never be called
-                warnings.warn('When you see this, something is wrong')
-                errors = ["Please provide a description to fill features."]
-                fields = prepare_fields(feature_schema, story)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=errors,
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=True
-                )
-            try:
-                # Generate the prompt messages
-                messages = feature_value_prefill_prompt(story, unit_type, description, feature_schema)
-                # Call OpenAI API
-                response_text = call_openai(messages)
-                # Parse the JSON response
-                feature_values = json.loads(response_text)
-                # Update form_data with feature_values
-                for key, value in feature_values.items():
-                    # Ensure the key is one of the features
-                    if key in feature_schema:
-                        if isinstance(value, list):
-                            form_data[key] = value
-                        else:
-                            form_data[key] = [str(value)]
-                        form_data[key] = value
-                for key, value in form_data.items():
-                    if ((key in feature_schema.keys() and feature_schema[key] != list)
-                        or key.endswith('_new')) and isinstance(value, list)\
-                            or key == 'unit_description':
-                        if len(value) > 1:
-                            raise ValueError("Expected at most one item in the list.")
-                        form_data[key] = value[0]
-                    # elif feature_schema[key] != list: raise ValueError("Unexpected form element")
-                # Re-render the form with updated form_data
-                fields = prepare_fields(feature_schema, story)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=[],
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=True
-                )
-            except json.JSONDecodeError as e:
-                errors = [f"Failed to parse AI response: {str(e)}", "AI response: " + response_text]
-                fields = prepare_fields(feature_schema, story)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=errors,
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=True
-                )
-            except Exception as e:
-                errors = [f"An error occurred while filling features: {str(e)}"]
-                fields = prepare_fields(feature_schema, story)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=errors,
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=True
-                )
-        elif action == 'save_unit':
-            # Process form submission
-            features, errors = process_form_submission(form_data, feature_schema, story, unit_name=unit.name)
+    # Process form submission
+    features, errors = process_form_submission(
+        request.form, feature_schema, story, unit_name=unit.name if edit_mode else None
+    )
 
-            # Validate 'name' field
-            new_name = features.get('name', '').strip()
-            if not new_name:
-                errors.append("Name is required.")
-            else:
-                # Check for duplicate names in the same story (excluding current unit)
-                existing_unit = get_unit_by_name(story_id, new_name)
-                if existing_unit and existing_unit.id != unit.id:
-                    errors.append(f"A unit with the name '{new_name}' already exists in this story.")
-
-            if errors:
-                # Re-render the form with error messages
-                fields = prepare_fields(feature_schema, story)
-                form_data = clean_form_data(form_data, fields)
-                return render_template(
-                    'add_unit.html',
-                    unit_type=unit_type,
-                    fields=fields,
-                    errors=errors,
-                    form_data=form_data,
-                    story=story,
-                    edit_mode=True
-                )
-            else:
-                # Capture the old name before updating
+    # Validate 'name' field
+    name = features.get('name', '').strip()
+    if not name:
+        errors.append("Name is required.")
+
+    if not errors:
+        features['name'] = name
+        # Unit names are unique per story, the database rejects duplicates
+        try:
+            if edit_mode:
+                # Capture the old name and features before updating
                 old_name = unit.name
-                # Update the unit's features
-                features['name'] = new_name
+                old_features = unit.features
                 unit.features = features
-                unit.name = new_name
-                update_unit(unit)
-                # After updating the unit, update references if needed
-                update_references_with_new_unit(unit, story, old_name)
-                flash(f"{unit_type} '{new_name}' has been updated.")
-                return redirect(url_for('main.index'))
+                unit.name = name
+                # Save the unit together with the references to it
+                try:
+                    update_references_with_new_unit(unit, story, old_name, write_unit=True)
+                except DuplicateNameError:
+                    # Nothing was written, so undo the rename on the loaded unit
+                    unit.features = old_features
+                    unit.name = old_name
+                    raise
+                finally:
+                    # Rebuild the story's name index used by get_unit
+                    story.units = story.units
+            else:
+                # Create the Unit and add it to the database, together with the story's
+                # updated undefined names
+                unit = unit_class(unit_type=unit_type, name=name, features=features, story_id=story.id)
+                add_unit_to_story(story.id, unit, user_email=current_user.email, is_copy=False, story=story)
+        except DuplicateNameError as e:
+            errors.append(str(e))
 
-    else:
-        # GET request, render form with existing data
+    if errors:
+        # Re-render the form with error messages
         fields = prepare_fields(feature_schema, story)
-        form_data = MultiDict(unit.features)
-        form_data = clean_form_data(form_data, fields)
-        return render_template(
-            'add_unit.html',
-            unit_type=unit_type,
-            fields=fields,
-            errors=[],
-            form_data=form_data,
-            story=story,
-            edit_mode=True
-        )
+        form_data = clean_form_data(request.form, fields)
+        return render_unit_form(story, unit_type, feature_schema, form_data, errors, edit_mode, fields=fields)
+
+    if edit_mode:
+        flash(f"{unit_type} '{name}' has been updated.")
+    else:
+        flash(f"{unit_type} '{name}' has been added.")
+    schedule_story_pdf_prerender(story.id)
+    return redirect(url_for('main.index'))
 
 @main_bp.route('/story/<int:story_id>/delete_unit/<unit_name>', methods=['GET'])
 @login_required
 def delete_unit(story_id, unit_name):
     """Route to delete a unit from a story."""
-    story = get_story_by_id(story_id)
-    if story is None:
-        abort(404, description="Story not found.")
-
-    if story.user_email != current_user.email:
-        abort(403)
+    story = load_story_or_abort(story_id)
 
     # Get the unit by name within the story
-    unit = get_unit_by_name(story_id, unit_name)
+    unit = story.get_unit(unit_name)
     if not unit:
         abort(404, description="Unit not found in this story.")
 
     # Delete the unit from the database
     delete_unit_from_story(unit)
 
+    schedule_story_pdf_prerender(story_id)
     flash(f"Unit '{unit_name}' has been deleted from the story.")
     return redirect(url_for('main.index'))
 
@@ -659,68 +531,53 @@ def delete_unit(story_id, unit_name):
 @main_bp.route('/story/<int:story_id>/download')
 @login_required
 def download_story(story_id):
-    story = get_story_by_id(story_id)
-    if story is None:
-        abort(404, description="Story not found.")
-    if story.user_email != current_user.email:
-        abort(403)
-
-    # Create a temporary file for the PDF
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-        tmp_filename = tmp_file.name
+    story = load_story_or_abort(story_id)
 
     try:
-        # Generate the PDF file into the temporary file.
-        story.to_pdf(tmp_filename)  # Make sure the to_pdf() method writes to the provided filename
-
-        # Send the file to the client.
-        return send_file(
-            tmp_filename,
+        # Render the PDF in memory (or reuse the cached rendering) and stream it to the client.
+        pdf_bytes, fingerprint = get_cached_export(story, 'pdf', story.to_pdf_bytes)
+        response = send_file(
+            io.BytesIO(pdf_bytes),
             as_attachment=True,
             download_name=f"{story.name}.pdf",
-            mimetype='application/pdf'
+            mimetype='application/pdf',
+            etag=f"{fingerprint}-pdf"
         )
+        response.cache_control.private = True
+        response.cache_control.max_age = 0
+        return response
     except Exception as e:
         flash(f"An error occurred while generating the PDF: {e}")
         return redirect(url_for('main.index'))
-    finally:
-        # Ensure the temporary file is deleted after sending.
-        if os.path.exists(tmp_filename):
-            os.remove(tmp_filename)
-
 
 
+# Encoder for JSON downloads, compact to keep the files small
+JSON_EXPORT_ENCODER = json.JSONEncoder(separators=(',', ':'))
 
 
 @main_bp.route('/story/<int:story_id>/download_json')
 @login_required
 def download_story_json(story_id):
     """Route to download the story as a JSON file."""
-    story = get_story_by_id(story_id)
-    if story is None:
-        abort(404, description="Story not found.")
-    if story.user_email != current_user.email:
-        abort(403)
+    story = load_story_or_abort(story_id)
 
-    # Generate the JSON representation
-    story_json = json.dumps(story.to_json(), indent=4)
+    # Serialize once; the same bytes are the download and the source of its ETag
+    story_json = story_json_bytes(story)
 
     # Create a response with the proper headers for file download
-    response = make_response(story_json)
+    response = Response(story_json, mimetype='application/json')
     response.headers.set('Content-Disposition', f'attachment; filename="{story.name}.json"')
-    response.headers.set('Content-Type', 'application/json')
-    return response
+    response.set_etag(f"{story_fingerprint(story, story_json)}-json")
+    response.cache_control.private = True
+    response.cache_control.max_age = 0
+    return response.make_conditional(request)
 
 
 @main_bp.route('/story/<int:story_id>/view')
 @login_required
 def view_story(story_id):
     """Route to view the story as HTML."""
-    story = get_story_by_id(story_id)
-    if story is None:
-        abort(404, description="Story not found.")
-    if story.user_email != current_user.email:
-        abort(403)
+    story = load_story_or_abort(story_id)
 
     # Generate the HTML representation
     story_html = story.to_html()
@@ -732,133 +589,297 @@ def view_story(story_id):
 @login_required
 def download_story_text(story_id):
     """Route to download the story as a text file."""
-    story = get_story_by_id(story_id)
-    if story is None:
-        abort(404, description="Story not found.")
-    if story.user_email != current_user.email:
-        abort(403)
-
-    # Use a temporary file to store the generated story
-    with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.txt') as tmp_file:
-        tmp_filename = tmp_file.name
+    story = load_story_or_abort(story_id)
 
     try:
-        # Generate the text file using the to_text method
-        story.to_text(filename=tmp_filename)
-
-        # Send the file to the client
-        return send_file(
-            tmp_filename,
-            as_attachment=True,
-            download_name=f"{story.name}.txt",
-            mimetype='text/plain'
-        )
+        # Generating the text is an OpenAI API call, so reuse it while the story is unchanged
+        fingerprint = story_fingerprint(story)
+        key = (story.id, 'txt', fingerprint)
+        text_bytes = lookup_export(key)
+        if text_bytes is not None:
+            response = send_file(
+                io.BytesIO(text_bytes),
+                as_attachment=True,
+                download_name=f"{story.name}.txt",
+                mimetype='text/plain',
+                etag=f"{fingerprint}-txt"
+            )
+        else:
+            # Send the story while it is being written. Wait for its first part, so a
+            # failing API call is still reported on the page instead of in the download.
+            chunks = story.generate_text_stream()
+            first_chunk = next(chunks, '')
+
+            def stream_text():
+                parts = [first_chunk]
+                yield first_chunk
+                for chunk in chunks:
+                    parts.append(chunk)
+                    yield chunk
+                store_export(key, ''.join(parts).encode('utf-8'))
+
+            response = Response(stream_text(), mimetype='text/plain')
+            response.headers.set('Content-Disposition', 'attachment', filename=f"{story.name}.txt")
+            response.set_etag(f"{fingerprint}-txt")
+        response.cache_control.private = True
+        response.cache_control.max_age = 0
+        return response
     except Exception as e:
         flash(f"An error occurred while generating the story: {e}")
         return redirect(url_for('main.index'))
-    finally:
-        # Clean up the temporary file after the request is complete
-        if os.path.exists(tmp_filename):
-            os.remove(tmp_filename)
 
-def prepare_fields(feature_schema, story):
-    """Prepare fields for the unit form based on the feature schema."""
-    fields = []
+
+# Rendered story exports, keyed by (story id, export kind, content fingerprint).
+# Editing a story changes its fingerprint, so outdated renderings are never served
+# and simply get evicted once the cache is full.
+EXPORT_CACHE_MAX_ENTRIES = 32
+_export_cache = OrderedDict()
+_export_cache_lock = threading.Lock()
+
+
+def story_json_bytes(story):
+    """Serialize the story as compact JSON, as offered for download."""
+    return JSON_EXPORT_ENCODER.encode(story.to_json()).encode('utf-8')
+
+
+def story_fingerprint(story, story_json=None):
+    """Hash the story content that the exports are generated from.
+
+    Args:
+        story (Story): The story.
+        story_json (bytes, optional): The story's story_json_bytes, if already at hand.
+    """
+    if story_json is None:
+        story_json = story_json_bytes(story)
+    return hashlib.sha256(story_json).hexdigest()
+
+
+def get_cached_export(story, kind, render):
+    """Return the cached export of a story, rendering it if the story has changed.
+
+    Args:
+        story (Story): The story to export.
+        kind (str): Name of the export format, e.g. 'pdf'.
+        render (callable): Produces the export as bytes.
+
+    Returns:
+        tuple: The export bytes and the story fingerprint.
+    """
+    fingerprint = story_fingerprint(story)
+    key = (story.id, kind, fingerprint)
+    data = lookup_export(key)
+    if data is None:
+        data = render()
+        store_export(key, data)
+    return data, fingerprint
+
+
+def lookup_export(key):
+    """Return the cached export for a (story id, kind, fingerprint) key, or None."""
+    with _export_cache_lock:
+        data = _export_cache.get(key)
+        if data is not None:
+            _export_cache.move_to_end(key)
+        return data
+
+
+def store_export(key, data):
+    """Cache an export under its (story id, kind, fingerprint) key."""
+    with _export_cache_lock:
+        _export_cache[key] = data
+        _export_cache.move_to_end(key)
+        while len(_export_cache) > EXPORT_CACHE_MAX_ENTRIES:
+            _export_cache.popitem(last=False)
+
+
+# Story PDFs are re-rendered in the background after edits so downloads hit the export cache
+export_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def schedule_story_pdf_prerender(story_id):
+    """Render a story's PDF into the export cache in a background thread."""
+    export_executor.submit(prerender_story_pdf, story_id)
+
+
+def prerender_story_pdf(story_id):
+    """Load a story and render its PDF into the export cache."""
+    try:
+        story = get_story_by_id(story_id)
+        if story is not None:
+            get_cached_export(story, 'pdf', story.to_pdf_bytes)
+    except Exception as e:
+        print(f"Error prerendering PDF for story {story_id}: {e}")
+
+
+# Form field type name and form value parser for each supported feature type.
+# List values are combined from several inputs by parse_list_value instead.
+FEATURE_TYPE_HANDLERS = {
+    bool: ('bool', lambda value: value == 'on'),
+    float: ('float', lambda value: float(value) if value else 0.0),
+    str: ('str', lambda value: value.strip() if value else ''),
+    int: ('int', lambda value: int(value) if value else 0),
+    list: ('list', None),
+}
+
+
+# Structures derived from a feature schema are built once and cached here, keyed by
+# the schema's (feature name, type) pairs; the schemas themselves are read-only mappings,
+# which cannot be dictionary keys.
+_schema_cache = {}
+
+
+def cached_for_schema(feature_schema, kind, build):
+    """Return build(feature_schema), computing it only once per schema and kind."""
+    key = (tuple(feature_schema.items()), kind)
+    cached = _schema_cache.get(key)
+    if cached is None:
+        cached = build(feature_schema)
+        _schema_cache[key] = cached
+    return cached
+
+
+def build_static_fields(feature_schema):
+    """Build the story independent field templates (name, type, required) for a schema."""
+    static_fields = []
     for feature_name, expected_type in feature_schema.items():
         if feature_name == 'name':
             field = {'name': feature_name, 'type': 'str', 'required': True}
-            if story.undefined_names:
-                field['options'] = story.undefined_names
         else:
             field = {'name': feature_name}
-            if expected_type == bool:
-                field['type'] = 'bool'
-            elif expected_type == float:
-                field['type'] = 'float'
-            elif expected_type == str:
-                field['type'] = 'str'
-            elif expected_type == int:
-                field['type'] = 'int'
-            elif expected_type == list:
-                field['type'] = 'list'
-                # Fetch all unit names from the story's units using the service layer
-                units = get_units_by_story_id(story.id)
-                field['options'] = [
-                    (unit.name, unit.name) for unit in units
-                ] + [
-                    (name, f"{name} (undefined)") for name in story.undefined_names
-                ]
-            else:
-                field['type'] = 'unknown'
+            field['type'] = FEATURE_TYPE_HANDLERS.get(expected_type, ('unknown', None))[0]
+        static_fields.append(field)
+    return static_fields
+
+
+def parse_name_value(form_data, feature_name):
+    """Parse the unit name."""
+    return form_data.get(feature_name, '').strip(), None
+
+
+def parse_list_value(form_data, feature_name):
+    """Combine selected options and comma separated new names of a list feature."""
+    selected_values = form_data.getlist(feature_name)
+    new_values = form_data.get(f"{feature_name}_new", '').strip().split(', ')
+    return [v.strip() for v in selected_values + new_values if v.strip()], None
+
+
+def parse_unsupported_value(form_data, feature_name):
+    """Keep the raw value of a feature with an unsupported type and report it."""
+    return form_data.get(feature_name, ''), f"Unsupported type for {feature_name}."
+
+
+def make_scalar_parser(expected_type):
+    """Create a parser for a bool, float, str or int feature."""
+    convert = FEATURE_TYPE_HANDLERS[expected_type][1]
+
+    def parse(form_data, feature_name):
+        try:
+            return convert(form_data.get(feature_name, '')), None
+        except ValueError:
+            return expected_type(), f"Invalid value for {feature_name}."
+    return parse
+
+
+def build_feature_parsers(feature_schema):
+    """Pick a parser for every feature of a schema.
+
+    Each parser takes (form_data, feature_name) and returns (value, error or None).
+    """
+    parsers = []
+    for feature_name, expected_type in feature_schema.items():
+        if feature_name == 'name':
+            parser = parse_name_value
+        elif expected_type == list:
+            parser = parse_list_value
+        elif expected_type in FEATURE_TYPE_HANDLERS:
+            parser = make_scalar_parser(expected_type)
+        else:
+            parser = parse_unsupported_value
+        parsers.append((feature_name, parser))
+    return parsers
+
+
+def prepare_fields(feature_schema, story):
+    """Prepare fields for the unit form based on the feature schema."""
+    fields = []
+    # All list fields share the same options, so fetch the story's units only once
+    list_options = None
+    if list in feature_schema.values():
+        list_options = [
+            (unit.name, unit.name) for unit in story.units
+        ] + [
+            (name, f"{name} (undefined)") for name in story.undefined_names
+        ]
+    for static_field in cached_for_schema(feature_schema, 'static_fields', build_static_fields):
+        field = dict(static_field)
+        if field['name'] == 'name':
+            if story.undefined_names:
+                field['options'] = story.undefined_names
+        elif field['type'] == 'list':
+            field['options'] = list_options
         fields.append(field)
     return fields
 
 def process_form_submission(form_data, feature_schema, story, unit_name=None):
-    """Process the form submission for adding or editing a unit."""
+    """Process the form submission for adding or editing a unit.
+
+    Args:
+        form_data (MultiDict): The submitted form, typically request.form.
+        feature_schema (dict): The schema of features for the unit type.
+        story (Story): The story the unit belongs to.
+        unit_name (str, optional): Current name of the unit when editing.
+
+    Returns:
+        tuple: The parsed features dict and a list of error messages.
+    """
     features = {}
     errors = []
 
     # Collect form data
-    for feature_name, expected_type in feature_schema.items():
-        if feature_name == 'name':
-            name = form_data.get(feature_name, [''])[0].strip()
-            features[feature_name] = name
-            continue
-
-        value = form_data.get(feature_name, [''])[0]
-        new_value = form_data.get(f"{feature_name}_new", [''])[0].strip()
-
-        if expected_type == bool:
-            features[feature_name] = (value == 'on')
-        elif expected_type == float:
-            try:
-                features[feature_name] = float(value) if value else 0.0
-            except ValueError:
-                errors.append(f"Invalid value for {feature_name}.")
-                features[feature_name] = 0.0
-        elif expected_type == str:
-            features[feature_name] = value.strip() if value else ''
-        elif expected_type == int:
-            try:
-                features[feature_name] = int(value) if value else 0
-            except ValueError:
-                errors.append(f"Invalid value for {feature_name}.")
-                features[feature_name] = 0
-        elif expected_type == list:
-            # selected_values = form_data.getlist(feature_name)
-            selected_values = form_data.get(feature_name)
-            if selected_values is None:
-                selected_values = []
-            if not selected_values:
-                selected_values = []
-            new_values = new_value.split(', ')
-
-            combined_values = [v.strip() for v in selected_values + new_values if v.strip()]
-
-            '''
-            # Add to undefined names if necessary
-            for v in combined_values:
-                related_unit = get_unit_by_name(story.id, v)
-                if not related_unit and v not in story.undefined_names:
-                    story.undefined_names.append(v)
-            '''
-            features[feature_name] = combined_values
-        else:
-            # Unsupported type
-            errors.append(f"Unsupported type for {feature_name}.")
-            features[feature_name] = value
-    # update_story(story)
+    for feature_name, parser in cached_for_schema(feature_schema, 'parsers', build_feature_parsers):
+        value, error = parser(form_data, feature_name)
+        features[feature_name] = value
+        if error:
+            errors.append(error)
     return features, errors
 
 
-def check_for_and_add_undefined_references(unit, story):
-    for feat, vals in unit.features.items():
-        if isinstance(vals, list):
-            for v in vals:
-                related_unit = get_unit_by_name(story.id, v)
-                if not related_unit and v not in story.undefined_names:
-                    story.undefined_names.append(v)
-    update_story(story)
+# Instructions shared by all prefill prompts. The static messages come first and the
+# story specific message last, so the API's prompt caching can reuse the common prefix.
+PREFILL_SYSTEM_PROMPT = """You are an assistant that helps fill out feature values for units in a story based on a description.
+A Unit is an element of the story.
+
+You will get the story information, the existing units of the story and a description of the unit to create.
+Please provide values for the features of the unit as a JSON object with the listed keys and appropriate values.
+
+Example response:
+{
+    "name": "Name of the unit",
+    "feature1": "value1",
+    "feature2": true,
+    "feature3": 0.5,
+    "feature4": ["item1", "item2"],
+    "feature5": "Some description"
+}
+
+Please ensure the response is valid JSON, starting with the first opening bracket "{" and ending with the last closing bracket "}".
+Do not include any text outside of the JSON object.
+
+You should make sure that the feature values are appropriate and consistent with the story and existing units.
+If a feature expects a list of names of existing units, please select appropriate ones from the existing units.
+If necessary, you may introduce new names, but prefer existing ones.
+"""
+
+
+def build_prompt_features(feature_schema):
+    """Build the schema dependent part of the feature prefill prompt."""
+    # List the features with their expected types
+    features_text = "Features:\n"
+    for feature_name, expected_type in feature_schema.items():
+        typename = expected_type.__name__ if isinstance(expected_type, type) else 'list'
+        features_text += f"- '{feature_name}' ({typename})\n"
+    return features_text
+
 
 def feature_value_prefill_prompt(story, unit_type, description, feature_schema):
     """
@@ -876,16 +897,10 @@ def feature_value_prefill_prompt(story, unit_type, description, feature_schema):
     if not description:
         description = f"The {unit_type} should fit well within the story."
     # Build existing units text
-    existing_units_text = ""
-    for unit in story.units:
-        existing_units_text += f"{unit.unit_type}: {unit.name}\n"
-        for key, value in unit.features.items():
-            existing_units_text += f"  {key}: {value}\n"
-        existing_units_text += "\n"
-
-    # Build the prompt
-    prompt = f"""Based on the following story information and the description, please provide values for the features of the unit type '{unit_type}' in JSON format.
-A Unit is an element of the story.
+    existing_units_text = story.to_text_list()
+
+    # Build the story specific part of the prompt
+    prompt = f"""Unit type: {unit_type}
 
 Story Setting and Style:
 {story.setting_and_style}
@@ -898,41 +913,12 @@ All already existing units of the story:
 
 Description of the {unit_type} to create:
 {description}
-
-Please provide a JSON object with the following keys and appropriate values:
-
-"""
-
-    # List the features with their expected types
-    prompt += "Features:\n"
-    for feature_name, expected_type in feature_schema.items():
-        typename = expected_type.__name__ if isinstance(expected_type, type) else 'list'
-        prompt += f"- '{feature_name}' ({typename})\n"
-
-    prompt += """
-
-Example response:
-{
-    "name": "Name of the unit",
-    "feature1": "value1",
-    "feature2": true,
-    "feature3": 0.5,
-    "feature4": ["item1", "item2"],
-    "feature5": "Some description"
-}
-
-Please ensure the response is valid JSON, starting with the first opening bracket "{" and ending with the last closing bracket "}".
-Do not include any text outside of the JSON object.
-
-You should make sure that the feature values are appropriate and consistent with the story and existing units.
-If a feature expects a list of names of existing units, please select appropriate ones from the existing units.
-If necessary, you may introduce new names, but prefer existing ones.
-
 """
 
     messages = [
-        {"role": "system",
-         "content": "You are an assistant that helps fill out feature values for units in a story based on a description."},
+        {"role": "system", "content": PREFILL_SYSTEM_PROMPT},
+        # The feature list only depends on the schema
+        {"role": "system", "content": cached_for_schema(feature_schema, 'prompt_features', build_prompt_features)},
         {"role": "user", "content": prompt}
     ]
     return messages
@@ -1,44 +1,54 @@
 import os
 
 
+def iter_files(directory, exclude_abs_paths):
+    """Yield (path, name) of the files below directory, files of a directory before its subdirectories."""
+    subdirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                # Skip hidden and excluded directories
+                if not entry.name.startswith('.') and entry.path not in exclude_abs_paths:
+                    subdirs.append(entry.path)
+            elif entry.is_file():
+                yield entry.path, entry.name
+    for subdir in subdirs:
+        yield from iter_files(subdir, exclude_abs_paths)
+
+
 def combine_files(output_file='combined_file.txt', allowed_extensions=None, exclude_list=None):
     if allowed_extensions is None:
         allowed_extensions = {'.py', '.html', '.css', '.js'}
 
+    allowed_extensions = frozenset(allowed_extensions)
+
     if exclude_list is None:
         exclude_list = []
+    exclude_names = frozenset(exclude_list)
 
     # Convert exclude_list to absolute paths for accurate comparison
-    exclude_abs_paths = [os.path.abspath(path) for path in exclude_list]
+    exclude_abs_paths = frozenset(os.path.abspath(path) for path in exclude_list)
 
-    # Get the current directory
-    current_dir = os.getcwd()
+    # Get the current directory; paths found below it are absolute already
+    current_dir = os.path.abspath(os.getcwd())
 
     # Open the output file in write mode
     with open(output_file, 'w', encoding='utf-8') as outfile:
-        # Walk through the directory tree
-        for root, dirs, files in os.walk(current_dir):
-            # Remove hidden directories from traversal
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
-
-            # Further exclude specified directories
-            dirs[:] = [d for d in dirs if os.path.abspath(os.path.join(root, d)) not in exclude_abs_paths]
-
-            for file in files:
-                file_ext = os.path.splitext(file)[1].lower()
-                file_path = os.path.join(root, file)
-                abs_file_path = os.path.abspath(file_path)
-
-                # Exclude files based on filename or their absolute path
-                if (file_ext in allowed_extensions) and (file not in exclude_list) and (
-                        abs_file_path not in exclude_abs_paths):
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as infile:
-                            outfile.write(f'===== {file_path} =====\n')
-                            outfile.write(infile.read())
-                            outfile.write('\n\n')  # Add spacing between files
-                    except Exception as e:
-                        print(f"Failed to read {file_path}: {e}")
+        for file_path, file in iter_files(current_dir, exclude_abs_paths):
+            # Exclude files based on filename or their absolute path
+            file_ext = os.path.splitext(file)[1].lower()
+            if (file_ext in allowed_extensions) and (file not in exclude_names) and (
+                    file_path not in exclude_abs_paths):
+                # Read the whole file first, so a file that fails to decode leaves no partial output
+                try:
+                    with open(file_path, 'r', encoding='utf-8') as infile:
+                        content = infile.read()
+                except Exception as e:
+                    print(f"Failed to read {file_path}: {e}")
+                    continue
+                outfile.write(f'===== {file_path} =====\n')
+                outfile.write(content)
+                outfile.write('\n\n')  # Add spacing between files
 
     print(f"All specified files have been successfully combined into `{output_file}`.")
 
@@ -10,27 +10,271 @@ All classes (User, Story, Unit, and subclasses) are independent from any databas
 """
 
 import sqlite3
+import copy
 import json
-from .new_models import (
-    User, Story, Unit, get_unit_class,
-    EventOrScene, Secret, Item, Beast,
-    Grouping, Motivation, Place, TransportationInfrastructure, Character
-)
+import logging
+import os
+from collections import OrderedDict
+from .new_models import User, Story, Unit, get_unit_class, UNIT_TYPE_TO_CLASS
 import re
-import random
+import secrets
 import string
+import threading
+import time
 
+try:
+    import orjson
+except ImportError:  # fall back to the standard library
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
 
 DATABASE_PATH = 'story_creator.db'
 
 NAY_NAY_CHARACTERS = r"[ ?'\[\],.]()"
 
+# Short-lived in-process cache for label filter results on the index page, enabled together
+# with the lookup cache below (TV4_LRU=1). Every function that writes units or labels clears it.
+UNIT_FILTER_CACHE_TIMEOUT = 60  # seconds
+UNIT_FILTER_CACHE_MAX_ENTRIES = 256
+_unit_filter_cache = {}
+_unit_filter_cache_lock = threading.Lock()
+_unit_filter_cache_generation = 0
+
+# Search terms shorter than this cannot use the trigram index and fall back to LIKE
+UNIT_FTS_MIN_QUERY_LENGTH = 3
+_unit_fts_available = {}
+
+# Units whose labels are fetched per query when loading units with their labels
+LABEL_QUERY_BATCH_SIZE = 500
+
+# Optional LRU cache of the rows behind single user and unit lookups, enabled with TV4_LRU=1.
+# Objects are rebuilt from the cached row on every hit, so callers can still modify what they get.
+# Writers drop the affected kind; writes from other processes are not seen, hence it is opt-in.
+LOOKUP_CACHE_ENABLED = os.environ.get('TV4_LRU') == '1'
+LOOKUP_CACHE_MAX_ENTRIES = 1024
+_lookup_cache = OrderedDict()
+_lookup_cache_lock = threading.Lock()
+_lookup_cache_generation = 0
+
+
+# Feature schemas of the Unit subclasses; each subclass has a table of the same name
+UNIT_SUBCLASS_SCHEMAS = {
+    subclass_name: unit_class.feature_schema
+    for subclass_name, unit_class in UNIT_TYPE_TO_CLASS.items()
+}
+
+
+def _json_dumps(value):
+    """Serialize a value to JSON text for storage, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    # Same compact, non-ASCII-escaping output as orjson
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def _json_loads(text):
+    """Parse stored JSON text, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+# Characters that cannot appear in a subclass table column name
+NON_WORD_PATTERN = re.compile(r'\W')
+
+
+def feature_column_name(feature_name):
+    """Derive the subclass table column name of a feature."""
+    return NON_WORD_PATTERN.sub('', feature_name.replace(' ', '_'))
+
+
+def _encode_list_feature(value):
+    return _json_dumps(value) if value is not None else _json_dumps([])
+
+
+def _encode_bool_feature(value):
+    return 1 if value else 0
+
+
+# How feature values are stored in the subclass tables; other types are stored as they are
+FEATURE_ENCODERS = {list: _encode_list_feature, bool: _encode_bool_feature}
+
+
+def _build_subclass_statements(subclass_name, feature_schema):
+    """Build the INSERT and UPDATE statements and the value encoders of a subclass table."""
+    columns = []
+    encoders = []
+    for feature_name, feature_type in feature_schema.items():
+        columns.append(feature_column_name(feature_name))
+        encoders.append((feature_name, FEATURE_ENCODERS.get(feature_type)))
+    columns_sql = ', '.join(['unit_id'] + columns)
+    placeholders = ', '.join(['?'] * (len(columns) + 1))
+    insert_sql = f'INSERT INTO {subclass_name} ({columns_sql}) VALUES ({placeholders})'
+    set_clause_sql = ', '.join(f'{column} = ?' for column in columns)
+    update_sql = f'UPDATE {subclass_name} SET {set_clause_sql} WHERE unit_id = ?'
+    return insert_sql, update_sql, encoders
+
+
+# Subclass table statements, built once; this also limits the table names used in SQL to known ones
+SUBCLASS_STATEMENTS = {
+    subclass_name: _build_subclass_statements(subclass_name, feature_schema)
+    for subclass_name, feature_schema in UNIT_SUBCLASS_SCHEMAS.items()
+}
+
+
+def _subclass_values(unit):
+    """Return the statements for the unit's subclass table and the encoded feature values."""
+    try:
+        insert_sql, update_sql, encoders = SUBCLASS_STATEMENTS[unit.unit_type]
+    except KeyError:
+        raise ValueError(f"Unknown unit type '{unit.unit_type}'.")
+    values = []
+    for feature_name, encode in encoders:
+        value = unit.features.get(feature_name)
+        values.append(encode(value) if encode else value)
+    return insert_sql, update_sql, values
+
+
+# One connection per thread, reused across calls (see connect)
+_thread_local = threading.local()
+
+
+class DuplicateNameError(ValueError):
+    """Raised when a story or unit would get a name that is already taken."""
+
+
+def _cached_lookup(key, query):
+    """Return the row for key from the lookup cache, or run query() and cache the row it finds.
+
+    Args:
+        key (tuple): The cache key; its first item is the kind ('user' or 'unit').
+        query (callable): Fetches the row from the database, returning None if there is none.
+    """
+    if not LOOKUP_CACHE_ENABLED:
+        return query()
+    with _lookup_cache_lock:
+        row = _lookup_cache.get(key)
+        if row is not None:
+            _lookup_cache.move_to_end(key)
+            return row
+        generation = _lookup_cache_generation
+    row = query()
+    if row is not None:
+        with _lookup_cache_lock:
+            # Skip rows read before a write that invalidated the cache in the meantime
+            if generation == _lookup_cache_generation:
+                _lookup_cache[key] = row
+                while len(_lookup_cache) > LOOKUP_CACHE_MAX_ENTRIES:
+                    _lookup_cache.popitem(last=False)
+    return row
+
+
+def _invalidate_lookups(*kinds):
+    """Drop the cached lookups of the given kinds after a write."""
+    global _lookup_cache_generation
+    with _lookup_cache_lock:
+        _lookup_cache_generation += 1
+        for key in [key for key in _lookup_cache if key[0] in kinds]:
+            del _lookup_cache[key]
+
+
+def connect():
+    """Return the current thread's connection to the story database.
+
+    The connection is opened on first use and then reused by every later call in the
+    same thread. Writers use it as `with connect() as conn:`, which commits or rolls back
+    at the end of the block but leaves the connection open. Read-only functions just take
+    a cursor from it, as a SELECT does not open a transaction that would need ending.
+
+    Returns:
+        sqlite3.Connection: The connection, set up for write-ahead logging (see init_db).
+    """
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is not None and _thread_local.path == DATABASE_PATH:
+        return conn
+    if conn is not None:
+        conn.close()
+    # sqlite3 keeps prepared statements per connection, keyed by SQL text; make room
+    # for all of this module's queries so they are only compiled once per thread
+    conn = sqlite3.connect(DATABASE_PATH, cached_statements=256)
+    # With WAL a commit only needs to fsync at checkpoints, which is still safe against crashes
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    # The connection is long-lived, so a larger page cache and memory-mapped reads pay off
+    conn.execute('PRAGMA cache_size = -65536')  # 64 MiB
+    conn.execute('PRAGMA mmap_size = 268435456')  # 256 MiB
+    _thread_local.conn = conn
+    _thread_local.path = DATABASE_PATH
+    return conn
+
+
+def _index_exists(cursor, index_name):
+    """Return whether the database has an index of the given name."""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,))
+    return cursor.fetchone() is not None
+
+
+def _rename_duplicate_names(cursor, table, scope_column):
+    """Rename rows whose name is already taken within their scope, without committing.
+
+    The oldest row keeps its name; the others get a ' (2)', ' (3)', ... suffix that is
+    still free. Used once, before the unique name index of the table is created.
+
+    Args:
+        cursor (sqlite3.Cursor): Cursor of the open transaction.
+        table (str): 'story' or 'unit'.
+        scope_column (str): Column within which names must be unique.
+    """
+    cursor.execute(f'''
+        SELECT id, {scope_column}, name FROM {table} t
+        WHERE id > (
+            SELECT MIN(id) FROM {table}
+            WHERE {scope_column} = t.{scope_column} AND name = t.name
+        )
+        ORDER BY id
+    ''')
+    for row_id, scope, name in cursor.fetchall():
+        suffix = 2
+        while True:
+            new_name = f"{name} ({suffix})"
+            cursor.execute(f'''
+                SELECT 1 FROM {table} WHERE {scope_column} = ? AND name = ?
+            ''', (scope, new_name))
+            if cursor.fetchone() is None:
+                break
+            suffix += 1
+        cursor.execute(f'UPDATE {table} SET name = ? WHERE id = ?', (new_name, row_id))
+        if table == 'unit':
+            _rename_unit_features(cursor, row_id, new_name)
+        logger.warning("Renamed duplicate %s '%s' (id %s) to '%s'", table, name, row_id, new_name)
+
+
+def _rename_unit_features(cursor, unit_id, new_name):
+    """Set the 'name' feature of a unit and its subclass table row, without committing."""
+    cursor.execute('''
+        UPDATE unit
+        SET features = json_set(features, '$.name', ?)
+        WHERE id = ? AND json_valid(features)
+    ''', (new_name, unit_id))
+    cursor.execute('SELECT unit_type FROM unit WHERE id = ?', (unit_id,))
+    unit_type = cursor.fetchone()[0]
+    if unit_type in UNIT_SUBCLASS_SCHEMAS:
+        cursor.execute(
+            f'UPDATE {unit_type} SET {feature_column_name("name")} = ? WHERE unit_id = ?',
+            (new_name, unit_id)
+        )
+
 
 def init_db():
     """Initialize the database by creating the necessary tables."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
 
+        # Write-ahead logging lets reads run alongside a write; the mode is stored in the file
+        cursor.execute('PRAGMA journal_mode = WAL')
+
         '''
         # Check if 'username' column exists; if not, alter the table to add it
         cursor.execute("PRAGMA table_info(user)")
@@ -60,6 +304,15 @@ def init_db():
             )
         ''')
 
+        # Story names are unique per user. Databases created before this index may hold
+        # duplicates, which are renamed first.
+        if not _index_exists(cursor, 'uq_story_user_email_name'):
+            _rename_duplicate_names(cursor, 'story', 'user_email')
+        cursor.execute('DROP INDEX IF EXISTS idx_story_user_email_name')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_story_user_email_name ON story (user_email, name)
+        ''')
+
         # Create Unit table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS unit (
@@ -73,25 +326,11 @@ def init_db():
         ''')
 
         # Create tables for each Unit subclass
-        unit_subclasses = {
-            'EventOrScene': EventOrScene.feature_schema,
-            'Secret': Secret.feature_schema,
-            'Item': Item.feature_schema,
-            'Beast': Beast.feature_schema,
-            'Grouping': Grouping.feature_schema,
-            'Motivation': Motivation.feature_schema,
-            'Place': Place.feature_schema,
-            'TransportationInfrastructure': TransportationInfrastructure.feature_schema,
-            'Character': Character.feature_schema,
-        }
-
-
-
-        for subclass_name, feature_schema in unit_subclasses.items():
+        for subclass_name, feature_schema in UNIT_SUBCLASS_SCHEMAS.items():
             # Start with the unit_id column
             table_columns = ['unit_id INTEGER']
             for feature_name, feature_type in feature_schema.items():
-                column_name = re.sub(r'\W', '', feature_name.replace(' ', '_'))
+                column_name = feature_column_name(feature_name)
 
                 # Determine column type
                 if feature_type == bool:
@@ -132,6 +371,16 @@ def init_db():
             # Create table for the subclass
             cursor.execute(sql_command)
 
+        # Unit names are unique within a story (also serves lookups by name); older
+        # duplicates are renamed first, as for stories. Renaming also updates the 'name'
+        # feature in the subclass tables, so this comes after they are created.
+        if not _index_exists(cursor, 'uq_unit_story_id_name'):
+            _rename_duplicate_names(cursor, 'unit', 'story_id')
+        cursor.execute('DROP INDEX IF EXISTS idx_unit_story_id_name')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_unit_story_id_name ON unit (story_id, name)
+        ''')
+
         # Create Label table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS label (
@@ -153,29 +402,103 @@ def init_db():
             )
         ''')
 
+        # Index for label filters; lookups by unit use the primary key
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_unit_label_label_id ON unit_label (label_id, unit_id)
+        ''')
+
+        # Label names are unique per user, and among the labels without a user.
+        # Databases created before these indexes may hold duplicates, which are merged first.
+        if not _index_exists(cursor, 'uq_label_name_user_email'):
+            cursor.execute('''
+                UPDATE OR IGNORE unit_label
+                SET label_id = (
+                    SELECT MIN(l2.id) FROM label l1
+                    JOIN label l2 ON l2.name = l1.name AND l2.user_email IS l1.user_email
+                    WHERE l1.id = unit_label.label_id
+                )
+            ''')
+            cursor.execute('''
+                DELETE FROM unit_label
+                WHERE label_id NOT IN (SELECT MIN(id) FROM label GROUP BY name, user_email)
+            ''')
+            cursor.execute('''
+                DELETE FROM label
+                WHERE id NOT IN (SELECT MIN(id) FROM label GROUP BY name, user_email)
+            ''')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_label_name_user_email ON label (name, user_email)
+            WHERE user_email IS NOT NULL
+        ''')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_label_name ON label (name)
+            WHERE user_email IS NULL
+        ''')
+
+        # Full-text index over unit name, type and features for the search box. The trigram
+        # tokenizer keeps the substring semantics of LIKE '%term%'. Triggers keep it in sync.
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'unit_fts'")
+        if cursor.fetchone() is None:
+            try:
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE unit_fts USING fts5(
+                        name, unit_type, features,
+                        content='unit', content_rowid='id', tokenize='trigram'
+                    )
+                ''')
+                cursor.execute("INSERT INTO unit_fts(unit_fts) VALUES('rebuild')")
+            except sqlite3.OperationalError as e:
+                # SQLite built without FTS5 or the trigram tokenizer; search keeps using LIKE
+                logger.warning("Full-text search unavailable: %s", e)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'unit_fts'")
+        if cursor.fetchone() is not None:
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS unit_fts_insert AFTER INSERT ON unit BEGIN
+                    INSERT INTO unit_fts(rowid, name, unit_type, features)
+                    VALUES (new.id, new.name, new.unit_type, new.features);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS unit_fts_delete AFTER DELETE ON unit BEGIN
+                    INSERT INTO unit_fts(unit_fts, rowid, name, unit_type, features)
+                    VALUES ('delete', old.id, old.name, old.unit_type, old.features);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS unit_fts_update AFTER UPDATE ON unit BEGIN
+                    INSERT INTO unit_fts(unit_fts, rowid, name, unit_type, features)
+                    VALUES ('delete', old.id, old.name, old.unit_type, old.features);
+                    INSERT INTO unit_fts(rowid, name, unit_type, features)
+                    VALUES (new.id, new.name, new.unit_type, new.features);
+                END
+            ''')
+        _unit_fts_available.pop(DATABASE_PATH, None)
+
+        # Let the query planner gather statistics for the indexes where they are missing or outdated
+        cursor.execute('PRAGMA optimize')
+
         conn.commit()
 
+USERNAME_ALPHABET = string.ascii_lowercase + string.digits
+USERNAME_ATTEMPTS = 10
+
 def generate_random_username(length=8):
-    """Generate a unique random username."""
-    while True:
-        username = ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
-        if not get_user_by_username(username):
-            return username
+    """Generate a random username; uniqueness is left to the user table's UNIQUE constraint."""
+    return ''.join(secrets.choice(USERNAME_ALPHABET) for _ in range(length))
 
 def get_user_by_username(username):
     """Check if a username already exists."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT email, username FROM user WHERE username = ?', (username,))
-        row = cursor.fetchone()
-        if row:
-            return User(email=row[0], username=row[1])
-        else:
-            return None
+    cursor = connect().cursor()
+    cursor.execute('SELECT email, username FROM user WHERE username = ?', (username,))
+    row = cursor.fetchone()
+    if row:
+        return User(email=row[0], username=row[1])
+    else:
+        return None
 
 def update_username(email, new_username):
     """Update the username and associated labels when a user changes their username."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         # Get the old username
         cursor.execute('SELECT username FROM user WHERE email = ?', (email,))
@@ -191,39 +514,30 @@ def update_username(email, new_username):
             WHERE email = ?
         ''', (new_username, email))
 
-        # Get the old label id
+        # Rename the user's label; this is skipped if a label with the new name exists already
         cursor.execute('''
-            SELECT id FROM label WHERE name = ? AND user_email IS NULL
-        ''', (old_username,))
-        old_label_row = cursor.fetchone()
-        if old_label_row:
-            old_label_id = old_label_row[0]
-            # Check if a label with new_username already exists
+            UPDATE OR IGNORE label
+            SET name = ?
+            WHERE name = ? AND user_email IS NULL
+        ''', (new_username, old_username))
+        if cursor.rowcount == 0:
+            # Move the old label's units over to the existing label, then drop the old label.
+            # Units that already carry both labels keep their old link until it is deleted.
             cursor.execute('''
-                SELECT id FROM label WHERE name = ? AND user_email IS NULL
-            ''', (new_username,))
-            new_label_row = cursor.fetchone()
-            if new_label_row:
-                # Label with new_username exists
-                new_label_id = new_label_row[0]
-                # Update unit_label table to point to new_label_id
-                cursor.execute('''
-                    UPDATE unit_label
-                    SET label_id = ?
-                    WHERE label_id = ?
-                ''', (new_label_id, old_label_id))
-                # Delete the old label
-                cursor.execute('''
-                    DELETE FROM label WHERE id = ?
-                ''', (old_label_id,))
-            else:
-                # Update the label's name to new_username
-                cursor.execute('''
-                    UPDATE label
-                    SET name = ?
-                    WHERE id = ?
-                ''', (new_username, old_label_id))
+                UPDATE OR IGNORE unit_label
+                SET label_id = (SELECT id FROM label WHERE name = ? AND user_email IS NULL)
+                WHERE label_id = (SELECT id FROM label WHERE name = ? AND user_email IS NULL)
+            ''', (new_username, old_username))
+            cursor.execute('''
+                DELETE FROM unit_label
+                WHERE label_id = (SELECT id FROM label WHERE name = ? AND user_email IS NULL)
+            ''', (old_username,))
+            cursor.execute('''
+                DELETE FROM label WHERE name = ? AND user_email IS NULL
+            ''', (old_username,))
         conn.commit()
+        clear_unit_filter_cache()
+        _invalidate_lookups('user')
 
 
 
@@ -237,14 +551,16 @@ def get_user_by_email(email):
     Returns:
         User or None: The User object if found, else None.
     """
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
+    def query():
+        cursor = connect().cursor()
         cursor.execute('SELECT email, username FROM user WHERE email = ?', (email,))
-        row = cursor.fetchone()
-        if row:
-            return User(email=row[0], username=row[1])
-        else:
-            return None
+        return cursor.fetchone()
+
+    row = _cached_lookup(('user', email), query)
+    if row:
+        return User(email=row[0], username=row[1])
+    else:
+        return None
 
 
 def create_user(email):
@@ -256,50 +572,37 @@ def create_user(email):
     Returns:
         User: The newly created User object.
     """
-    username = generate_random_username()
-    with sqlite3.connect(DATABASE_PATH) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
-        cursor.execute('INSERT INTO user (email, username) VALUES (?, ?)', (email, username))
+        # Insert with a random username and draw a new one only if it is already taken
+        for attempt in range(USERNAME_ATTEMPTS):
+            username = generate_random_username()
+            try:
+                cursor.execute('INSERT INTO user (email, username) VALUES (?, ?)', (email, username))
+                break
+            except sqlite3.IntegrityError as e:
+                if 'user.username' not in str(e) or attempt == USERNAME_ATTEMPTS - 1:
+                    raise
         conn.commit()
         return User(email=email, username=username)
 
 
-def get_stories_by_user_email(user_email):
-    """Retrieve all stories associated with a user.
+def get_story_summaries_by_user_email(user_email):
+    """Retrieve the IDs and names of a user's stories, e.g. to list them.
+
+    No story details or units are loaded.
 
     Args:
         user_email (str): The user's email.
 
     Returns:
-        list of Story: A list of Story objects.
+        list of dict: One {'id', 'name'} dictionary per story.
     """
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name, undefined_names, setting_and_style, main_challenge
-            FROM story WHERE user_email = ?
-        ''', (user_email,))
-        stories = []
-        rows = cursor.fetchall()
-        for row in rows:
-            story_id = row[0]
-            story = Story(
-                id=story_id,
-                name=row[1],
-                user_email=user_email,
-                setting_and_style=row[3],
-                main_challenge=row[4]
-            )
-            undefined_names_json = row[2]
-            if undefined_names_json:
-                story.undefined_names = json.loads(undefined_names_json)
-            else:
-                story.undefined_names = []
-
-            # Load units associated with the story
-            story.units = get_units_by_story_id(story_id)
-            stories.append(story)
-        return stories
+    cursor = connect().cursor()
+    cursor.execute('''
+        SELECT id, name FROM story WHERE user_email = ?
+    ''', (user_email,))
+    return [{'id': row[0], 'name': row[1]} for row in cursor]
 
 
 def create_story(name, user_email, setting_and_style, main_challenge):
@@ -313,13 +616,19 @@ def create_story(name, user_email, setting_and_style, main_challenge):
 
     Returns:
         Story: The newly created Story object.
+
+    Raises:
+        DuplicateNameError: If the user already has a story with this name.
     """
-    with sqlite3.connect(DATABASE_PATH) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO story (name, user_email, undefined_names, setting_and_style, main_challenge)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (name, user_email, json.dumps([]), setting_and_style, main_challenge))
+        try:
+            cursor.execute('''
+                INSERT INTO story (name, user_email, undefined_names, setting_and_style, main_challenge)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (name, user_email, _json_dumps([]), setting_and_style, main_challenge))
+        except sqlite3.IntegrityError:
+            raise DuplicateNameError(f"A story with the name '{name}' already exists.")
         conn.commit()
         story_id = cursor.lastrowid
         return Story(
@@ -340,110 +649,163 @@ def get_story_by_id(story_id):
     Returns:
         Story or None: The Story object if found, else None.
     """
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name, user_email, undefined_names, setting_and_style, main_challenge
-            FROM story WHERE id = ?
-        ''', (story_id,))
-        row = cursor.fetchone()
-        if row:
-            story = Story(
-                id=row[0],
-                name=row[1],
-                user_email=row[2],
-                setting_and_style=row[4],
-                main_challenge=row[5]
-            )
-            undefined_names_json = row[3]
-            if undefined_names_json:
-                story.undefined_names = json.loads(undefined_names_json)
-            else:
-                story.undefined_names = []
-
-            # Load units associated with the story
-            story.units = get_units_by_story_id(story_id)
-            return story
-        else:
-            return None
+    cursor = connect().cursor()
+    cursor.execute('''
+        SELECT id, name, user_email, undefined_names, setting_and_style, main_challenge
+        FROM story WHERE id = ?
+    ''', (story_id,))
+    return _story_from_row(cursor.fetchone())
 
 
-def add_unit_to_story(story_id, unit, user_email=None, is_copy=False):
-    """Add a unit to a story and assign automatic labels."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
+def get_story_for_user(story_id, user_email):
+    """Retrieve a story by its ID if it belongs to the given user.
 
-        # Insert into unit table
-        cursor.execute('''
-            INSERT INTO unit (unit_type, name, story_id, features)
-            VALUES (?, ?, ?, ?)
-        ''', (unit.unit_type, unit.name, story_id, json.dumps(unit.features)))
-        conn.commit()
-        unit_id = cursor.lastrowid
-        unit.id = unit_id
-        unit.story_id = story_id
-
-        # Insert into subclass table
-        subclass_name = unit.unit_type
-        if subclass_name:
-
-            # Prepare columns and values based on feature_schema
-            feature_schema = type(unit).feature_schema
-            columns = []
-            values = []
-            for feature_name, feature_type in feature_schema.items():
-                column_name = re.sub(r'\W', '', feature_name.replace(' ', '_'))
-                value = unit.features.get(feature_name)
-
-                if feature_type == list:
-                    value = json.dumps(value) if value is not None else json.dumps([])
-                elif feature_type == bool:
-                    value = 1 if value else 0
-                columns.append(column_name)
-                values.append(value)
+    Args:
+        story_id (int): The story's ID.
+        user_email (str): The email of the user who must own the story.
 
-            columns_sql = ', '.join(['unit_id'] + columns)
-            placeholders = ', '.join(['?'] * (len(values) + 1))
-            values = [unit_id] + values
+    Returns:
+        Story or None: The Story object if found and owned by the user, else None.
+    """
+    cursor = connect().cursor()
+    cursor.execute('''
+        SELECT id, name, user_email, undefined_names, setting_and_style, main_challenge
+        FROM story WHERE id = ? AND user_email = ?
+    ''', (story_id, user_email))
+    return _story_from_row(cursor.fetchone())
+
+
+def _story_from_row(row):
+    """Build a Story with its units from a story table row, or return None for no row."""
+    if not row:
+        return None
+    story = Story(
+        id=row[0],
+        name=row[1],
+        user_email=row[2],
+        setting_and_style=row[4],
+        main_challenge=row[5]
+    )
+    undefined_names_json = row[3]
+    if undefined_names_json:
+        story.undefined_names = _json_loads(undefined_names_json)
+    else:
+        story.undefined_names = []
+
+    # Load units associated with the story
+    story.units = get_units_by_story_id(story.id)
+    return story
+
+
+def _row_to_unit(row):
+    """Build a Unit from a row starting with id, unit_type, name, features, story_id."""
+    unit_id, unit_type, name, features_json, story_id = row[:5]
+    return get_unit_class(unit_type)(
+        id=unit_id,
+        unit_type=unit_type,
+        name=name,
+        story_id=story_id,
+        features=_json_loads(features_json) if features_json else {}
+    )
+
+
+def add_unit_to_story(story_id, unit, user_email=None, is_copy=False, story=None):
+    """Add a unit to a story and assign automatic labels.
+
+    Raises:
+        DuplicateNameError: If the story already has a unit with this name.
+    """
+    return add_units_to_story(story_id, [unit], user_email=user_email, is_copy=is_copy, story=story)[0]
 
-            sql_command = f'''
-                INSERT INTO {subclass_name} ({columns_sql})
-                VALUES ({placeholders})
-            '''
 
-            cursor.execute(sql_command, values)
-            conn.commit()
-    # Assign automatic labels
-    story = get_story_by_id(story_id)
-    username = None
-    if user_email:
-        user = get_user_by_email(user_email)
-        username = user.username
+def add_units_to_story(story_id, units, user_email=None, is_copy=False, story=None):
+    """Add several units to a story and assign automatic labels, in one transaction.
 
-    labels_to_assign = []
+    The story and user are looked up once, and the subclass rows and labels are
+    written with one executemany per statement, so importing or copying many units
+    costs little more than adding one.
 
-    # Label for story name
-    story_label_id = get_or_create_label(story.name)
-    labels_to_assign.append(story_label_id)
+    Args:
+        story_id (int): The story's ID.
+        units (list of Unit): The units to add. Their id and story_id are set.
+        user_email (str, optional): Email of the creator, whose username becomes a label.
+        is_copy (bool, optional): Whether the units are copies, labelled 'copy'.
+        story (Story, optional): The loaded story. If given, its undefined_names are
+            updated for the new units and saved in the same transaction.
 
-    # Label for unit_type
-    unit_type_label_id = get_or_create_label(unit.unit_type)
-    labels_to_assign.append(unit_type_label_id)
+    Returns:
+        list of Unit: The added units.
 
-    # Label for creator username
-    if username:
-        username_label_id = get_or_create_label(username)
-        labels_to_assign.append(username_label_id)
+    Raises:
+        DuplicateNameError: If the story already has a unit with one of the names, or
+            two of the units share a name. No unit is added in that case.
+    """
+    if not units:
+        return []
 
-    # Label for "copy" if applicable
-    if is_copy:
-        copy_label_id = get_or_create_label('copy')
-        labels_to_assign.append(copy_label_id)
+    # The units, their subclass rows and their labels are written in one transaction
+    with connect() as conn:
+        cursor = conn.cursor()
 
-    # Assign labels to unit
-    assign_labels_to_units(labels_to_assign, [unit_id])
+        # Only the story name and the username are needed for the automatic labels
+        cursor.execute('SELECT name FROM story WHERE id = ?', (story_id,))
+        story_name = cursor.fetchone()[0]
+        username = None
+        if user_email:
+            cursor.execute('SELECT username FROM user WHERE email = ?', (user_email,))
+            username = cursor.fetchone()[0]
+
+        subclass_rows = {}
+        unit_ids_by_type = {}
+        for unit in units:
+            # Insert into unit table; each row's ID is needed for its subclass row
+            try:
+                cursor.execute('''
+                    INSERT INTO unit (unit_type, name, story_id, features)
+                    VALUES (?, ?, ?, ?)
+                ''', (unit.unit_type, unit.name, story_id, _json_dumps(unit.features)))
+            except sqlite3.IntegrityError:
+                raise DuplicateNameError(f"A unit with the name '{unit.name}' already exists in this story.")
+            unit.id = cursor.lastrowid
+            unit.story_id = story_id
+
+            insert_sql, _, values = _subclass_values(unit)
+            subclass_rows.setdefault(insert_sql, []).append([unit.id] + values)
+            unit_ids_by_type.setdefault(unit.unit_type, []).append(unit.id)
+
+        # Insert into subclass tables
+        for insert_sql, rows in subclass_rows.items():
+            cursor.executemany(insert_sql, rows)
+
+        # Assign automatic labels: story name, unit type, creator username, and "copy" if applicable
+        shared_label_names = [story_name]
+        if username:
+            shared_label_names.append(username)
+        if is_copy:
+            shared_label_names.append('copy')
+        label_names = shared_label_names + list(unit_ids_by_type)
+        label_ids = dict(zip(label_names, _get_or_create_labels(cursor, label_names)))
+        shared_label_ids = [label_ids[label_name] for label_name in shared_label_names]
+        for unit_type, unit_ids in unit_ids_by_type.items():
+            _assign_labels_to_units(cursor, shared_label_ids + [label_ids[unit_type]], unit_ids)
+
+        # The units are inserted already, so the name check below sees them
+        if story is not None:
+            previous_undefined_names = list(story.undefined_names)
+            try:
+                _update_undefined_names(story, units)
+                cursor.execute('''
+                    UPDATE story
+                    SET undefined_names = ?
+                    WHERE id = ?
+                ''', (_json_dumps(story.undefined_names), story_id))
+            except Exception:
+                story.undefined_names = previous_undefined_names
+                raise
+        conn.commit()
+    clear_unit_filter_cache()
 
-    return unit
+    return units
 
 
 def get_units_by_story_id(story_id):
@@ -455,309 +817,412 @@ def get_units_by_story_id(story_id):
     Returns:
         list of Unit: A list of Unit objects.
     """
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, unit_type, name, features
-            FROM unit WHERE story_id = ?
-        ''', (story_id,))
-        units = []
-        rows = cursor.fetchall()
-        for row in rows:
-            unit_id = row[0]
-            unit_type = row[1]
-            name = row[2]
-            features_json = row[3]
-            features = json.loads(features_json) if features_json else {}
-
-            # Create unit instance
-            unit_class = get_unit_class(unit_type)  # Use the function here
-            unit = unit_class(
-                unit_type=unit_type,
-                name=name,
-                story_id=story_id,
-                features=features,
-                id=unit_id
-            )
-            units.append(unit)
-        return units
+    return get_units_by_story_ids([story_id]).get(story_id, [])
+
 
+def get_units_by_story_ids(story_ids):
+    """Retrieve the units of several stories with a single query.
 
-def get_unit_by_name(story_id, unit_name):
-    """Retrieve a unit by name within a story.
+    Args:
+        story_ids (list of int): The stories' IDs.
+
+    Returns:
+        dict: Maps each story ID that has units to its list of Unit objects.
+    """
+    units_by_story = {}
+    if not story_ids:
+        return units_by_story
+    cursor = connect().cursor()
+    placeholders = ', '.join(['?'] * len(story_ids))
+    cursor.execute(f'''
+        SELECT id, unit_type, name, features, story_id
+        FROM unit WHERE story_id IN ({placeholders})
+        ORDER BY id
+    ''', list(story_ids))
+    for unit in map(_row_to_unit, cursor):
+        units_by_story.setdefault(unit.story_id, []).append(unit)
+    return units_by_story
+
+
+def get_existing_unit_names(story_id, names):
+    """Return which of the given names belong to units of a story.
 
     Args:
         story_id (int): The story's ID.
-        unit_name (str): The unit's name.
+        names (iterable of str): Candidate unit names.
 
     Returns:
-        Unit or None: The Unit object if found, else None.
+        set of str: The subset of names that exist as units in the story.
     """
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
+    names = list(set(names))
+    if not names:
+        return set()
+
+    placeholders = ','.join(['?'] * len(names))
+    cursor = connect().cursor()
+    cursor.execute(f'''
+        SELECT name FROM unit WHERE story_id = ? AND name IN ({placeholders})
+    ''', [story_id] + names)
+    return {row[0] for row in cursor}
+
+
+def _write_unit(cursor, unit):
+    """Write a unit's name and features to the unit and subclass tables without committing."""
+    # Update unit table
+    try:
         cursor.execute('''
-            SELECT id, unit_type, name, features
-            FROM unit WHERE story_id = ? AND name = ?
-        ''', (story_id, unit_name))
-        row = cursor.fetchone()
-        if row:
-            unit_id = row[0]
-            unit_type = row[1]
-            name = row[2]
-            features_json = row[3]
-            features = json.loads(features_json) if features_json else {}
-
-            # Create unit instance
-            unit_class = get_unit_class(unit_type)  # Use the function here
-            unit = unit_class(
-                id=unit_id,
-                unit_type=unit_type,
-                name=name,
-                story_id=story_id,
-                features=features
-            )
-            return unit
-        else:
-            return None
+            UPDATE unit
+            SET name = ?, features = ?
+            WHERE id = ?
+        ''', (unit.name, _json_dumps(unit.features), unit.id))
+    except sqlite3.IntegrityError:
+        raise DuplicateNameError(f"A unit with the name '{unit.name}' already exists in this story.")
 
+    # Update subclass table
+    _, update_sql, values = _subclass_values(unit)
+    cursor.execute(update_sql, values + [unit.id])
 
-def update_unit(unit):
-    """Update an existing unit.
+
+def _get_units_mentioning(story_id, name, exclude_unit_id):
+    """Retrieve the units of a story whose features contain a name as a text value.
+
+    json_tree also walks list features, so both single names and lists of names
+    match. Units that don't mention the name are not loaded at all.
 
     Args:
-        unit (Unit): The unit to update.
+        story_id (int): The story's ID.
+        name (str): The name to look for.
+        exclude_unit_id (int): ID of a unit to leave out, e.g. the named unit itself.
+
+    Returns:
+        list of Unit: The matching units.
     """
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
+    cursor = connect().cursor()
+    cursor.execute('''
+        SELECT id, unit_type, name, features, story_id
+        FROM unit
+        WHERE story_id = ? AND id != ?
+        AND EXISTS (
+            SELECT 1 FROM json_tree(unit.features)
+            WHERE json_tree.type = 'text' AND json_tree.value = ?
+        )
+        ORDER BY id
+    ''', (story_id, exclude_unit_id, name))
+    return list(map(_row_to_unit, cursor))
 
-        # Update unit table
-        cursor.execute('''
-            UPDATE unit
-            SET name = ?, features = ?
-            WHERE id = ?
-        ''', (unit.name, json.dumps(unit.features), unit.id))
-        conn.commit()
 
-        # Update subclass table
-        subclass_name = unit.unit_type
-        if subclass_name:
-            feature_schema = type(unit).feature_schema
-            set_clauses = []
-            values = []
-            for feature_name, feature_type in feature_schema.items():
-                column_name = re.sub(r'\W', '', feature_name.replace(' ', '_'))
-
-                value = unit.features.get(feature_name)
-                if feature_type == list:
-                    value = json.dumps(value) if value is not None else json.dumps([])
-                elif feature_type == bool:
-                    value = 1 if value else 0
-                set_clauses.append(f"{column_name} = ?")
-                values.append(value)
-            set_clause_sql = ', '.join(set_clauses)
-            values.append(unit.id)
-            cursor.execute(f'''
-                UPDATE {subclass_name}
-                SET {set_clause_sql}
-                WHERE unit_id = ?
-            ''', values)
-            conn.commit()
+def _write_unit_features(cursor, units):
+    """Write the features of several units without committing.
+
+    The units keep their names, so each table gets a single executemany.
+    """
+    cursor.executemany('''
+        UPDATE unit
+        SET features = ?
+        WHERE id = ?
+    ''', [(_json_dumps(unit.features), unit.id) for unit in units])
+
+    # Units of the same type share their subclass table's statement
+    rows_by_statement = {}
+    for unit in units:
+        _, update_sql, values = _subclass_values(unit)
+        rows_by_statement.setdefault(update_sql, []).append(values + [unit.id])
+    for update_sql, rows in rows_by_statement.items():
+        cursor.executemany(update_sql, rows)
+
+
+def _update_undefined_names(story, units):
+    """Update story.undefined_names in memory after units were added, named or renamed.
+
+    Names the units refer to become undefined unless a unit of the story has them, and
+    the units' own names are defined.
+    """
+    # add new undefined names that these units create
+    referenced_names = [
+        v for unit in units for vals in unit.features.values() if isinstance(vals, list) for v in vals
+    ]
+    existing_names = get_existing_unit_names(story.id, referenced_names)
+    for v in referenced_names:
+        if v not in existing_names:
+            story.add_undefined_name(v)
 
+    # Remove the unit names from undefined_names if present
+    for unit in units:
+        story.remove_undefined_name(unit.name)
 
 
-def update_references_with_new_unit(unit, story, old_name=None):
+def update_references_with_new_unit(unit, story, old_name=None, write_unit=False):
     """Update references to a unit's old or undefined name in other units after naming or renaming.
 
     Args:
         unit (Unit): The unit that was updated or created.
         story (Story): The story containing the units.
         old_name (str or None): The old name of the unit before renaming, or None if it's newly defined.
+        write_unit (bool): Whether to also save the unit itself, in the same transaction as
+            the references. Defaults to False, for units that are saved already.
+
+    Raises:
+        DuplicateNameError: If write_unit is set and another unit of the story already
+            has the unit's name. Nothing is written in that case.
     """
-    # add new undefined names that this unit creates
-    for feat, vals in unit.features.items():
-        if isinstance(vals, list):
-            for v in vals:
-                related_unit = get_unit_by_name(story.id, v)
-                if not related_unit and v not in story.undefined_names:
-                    story.undefined_names.append(v)
-    update_story(story)
-
-    # Remove the unit name from undefined_names if present
-    if unit.name in story.undefined_names:
-        story.undefined_names.remove(unit.name)
-        update_story(story)
-
-    units = get_units_by_story_id(story.id)
-    for other_unit in units:
-        if other_unit.id == unit.id:
-            continue  # Skip the updated unit itself
-        updated = False
-        feature_schema = type(other_unit).feature_schema
-        for feature_name, expected_type in feature_schema.items():
-            value = other_unit.features.get(feature_name)
-            if expected_type == list and isinstance(value, list):
-                if old_name and old_name in value:
-                    new_value = [unit.name if v == old_name else v for v in value]
-                    other_unit.features[feature_name] = new_value
-                    updated = True
-                elif unit.name in value and unit.name not in [u.name for u in units]:
-                    # Replace undefined name with the defined unit's name
-                    updated = True
-            elif expected_type == str and isinstance(value, str):
-                if value == old_name:
-                    other_unit.features[feature_name] = unit.name
-                    updated = True
-                elif value == unit.name and unit.name not in [u.name for u in units]:
-                    # Replace undefined name with the defined unit's name
-                    other_unit.features[feature_name] = unit.name
-                    updated = True
-        if updated:
-            update_unit(other_unit)
-
-
-def update_story(story):
-    """Update an existing story in the database."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
+    previous_undefined_names = list(story.undefined_names)
+    _update_undefined_names(story, [unit])
+
+    # Only a rename changes other units; the unit itself is saved already, so its
+    # name is defined and references to it stay as they are.
+    updated_units = {}
+    if old_name and old_name != unit.name:
+        candidates = _get_units_mentioning(story.id, old_name, unit.id)
+        for other_unit, feature_name in story.reference_index(candidates).get(old_name, []):
+            value = other_unit.features[feature_name]
+            if isinstance(value, list):
+                other_unit.features[feature_name] = [unit.name if v == old_name else v for v in value]
+            else:
+                other_unit.features[feature_name] = unit.name
+            updated_units[other_unit.id] = other_unit
+
+    # Write the story and all changed units in a single transaction
+    with connect() as conn:
         cursor = conn.cursor()
+        if write_unit:
+            try:
+                _write_unit(cursor, unit)
+            except DuplicateNameError:
+                story.undefined_names = previous_undefined_names
+                raise
         cursor.execute('''
             UPDATE story
             SET undefined_names = ?
             WHERE id = ?
-        ''', (json.dumps(story.undefined_names), story.id))
+        ''', (_json_dumps(story.undefined_names), story.id))
+        if updated_units:
+            _write_unit_features(cursor, updated_units.values())
         conn.commit()
+    if write_unit or updated_units:
+        clear_unit_filter_cache()
+        _invalidate_lookups('unit')
 
 
-def get_or_create_label(label_name, user_email=None):
-    """Retrieve label by name and user_email, or create it if not exists."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        if user_email:
-            cursor.execute('''
-                SELECT id FROM label WHERE name = ? AND user_email = ?
-            ''', (label_name, user_email))
-        else:
-            cursor.execute('''
-                SELECT id FROM label WHERE name = ? AND user_email IS NULL
-            ''', (label_name,))
-        row = cursor.fetchone()
-        if row:
-            return row[0]
-        else:
-            return create_label(label_name, user_email)
-
-def create_label(label_name, user_email=None):
-    """Create a new label."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
+def _find_label(cursor, label_name, user_email=None):
+    """Return the ID of the label with this name and user, or None."""
+    if user_email:
         cursor.execute('''
-            INSERT INTO label (name, user_email) VALUES (?, ?)
+            SELECT id FROM label WHERE name = ? AND user_email = ?
         ''', (label_name, user_email))
-        conn.commit()
-        label_id = cursor.lastrowid
-        return label_id
+    else:
+        cursor.execute('''
+            SELECT id FROM label WHERE name = ? AND user_email IS NULL
+        ''', (label_name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _get_or_create_labels(cursor, label_names):
+    """Look up or insert several labels without a user on the given cursor, without committing.
+
+    The existing labels are looked up with a single query.
+
+    Returns:
+        list of int: The label IDs, in the order of label_names.
+    """
+    placeholders = ', '.join(['?'] * len(label_names))
+    cursor.execute(f'''
+        SELECT name, id FROM label WHERE user_email IS NULL AND name IN ({placeholders})
+    ''', label_names)
+    label_ids = dict(cursor)
+    for label_name in label_names:
+        if label_name not in label_ids:
+            label_ids[label_name] = _create_label(cursor, label_name)
+    return [label_ids[label_name] for label_name in label_names]
+
+
+def _create_label(cursor, label_name, user_email=None):
+    """Insert a label on the given cursor, without committing.
+
+    Returns:
+        int: The ID of the new label, or of the existing one if the name is taken.
+    """
+    cursor.execute('''
+        INSERT OR IGNORE INTO label (name, user_email) VALUES (?, ?)
+    ''', (label_name, user_email))
+    if cursor.rowcount == 1:
+        return cursor.lastrowid
+    # The label exists already, e.g. created by a concurrent request
+    return _find_label(cursor, label_name, user_email)
 
-def assign_labels_to_units(label_ids, unit_ids):
-    """Assign multiple labels to multiple units."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
+
+def _assign_labels_to_units(cursor, label_ids, unit_ids):
+    """Insert the unit_label rows on the given cursor, without committing."""
+    entries = [(unit_id, label_id) for unit_id in unit_ids for label_id in label_ids]
+    cursor.executemany('''
+        INSERT OR IGNORE INTO unit_label (unit_id, label_id) VALUES (?, ?)
+    ''', entries)
+
+def create_label_for_units(label_name, user_email, unit_ids):
+    """Create a new label and assign it to the given units in one transaction.
+
+    Args:
+        label_name (str): Name of the label.
+        user_email (str): Email of the user creating the label.
+        unit_ids (list of int): IDs of the units to label.
+
+    Returns:
+        int: The ID of the label; an existing label of the user with this name is reused.
+    """
+    with connect() as conn:
         cursor = conn.cursor()
-        entries = [(unit_id, label_id) for unit_id in unit_ids for label_id in label_ids]
+        label_id = _create_label(cursor, label_name, user_email)
         cursor.executemany('''
             INSERT OR IGNORE INTO unit_label (unit_id, label_id) VALUES (?, ?)
-        ''', entries)
+        ''', [(unit_id, label_id) for unit_id in unit_ids])
         conn.commit()
+        clear_unit_filter_cache()
+        return label_id
 
 def get_all_labels():
     """Retrieve all labels."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name FROM label
-        ''')
-        labels = [{'id': row[0], 'name': row[1]} for row in cursor.fetchall()]
-        return labels
+    cursor = connect().cursor()
+    cursor.execute('''
+        SELECT id, name FROM label
+    ''')
+    labels = [{'id': row[0], 'name': row[1]} for row in cursor]
+    return labels
 
 
 
-def get_units_by_label_filters(include_label_ids, exclude_label_ids, search_query=None):
-    """Retrieve units filtered by including and excluding labels, and search query."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
+def clear_unit_filter_cache():
+    """Drop all cached label filter results."""
+    global _unit_filter_cache_generation
+    with _unit_filter_cache_lock:
+        _unit_filter_cache_generation += 1
+        _unit_filter_cache.clear()
 
-        # Base query
-        query = '''
-            SELECT DISTINCT u.id, u.unit_type, u.name, u.features, u.story_id,
-                   GROUP_CONCAT(l.name) as labels
-            FROM unit u
-            LEFT JOIN unit_label ul ON u.id = ul.unit_id
-            LEFT JOIN label l ON ul.label_id = l.id
-        '''
-        params = []
 
-        conditions = []
+def get_units_by_label_filters(include_label_ids, exclude_label_ids, search_query=None, limit=None, offset=0):
+    """Retrieve units filtered by including and excluding labels, and search query.
 
-        # Include labels (logical OR)
-        if include_label_ids:
-            include_placeholders = ','.join(['?'] * len(include_label_ids))
-            query += f'''
-                JOIN unit_label ul_include ON u.id = ul_include.unit_id AND ul_include.label_id IN ({include_placeholders})
-            '''
-            params.extend(include_label_ids)
+    With LOOKUP_CACHE_ENABLED, results are cached for UNIT_FILTER_CACHE_TIMEOUT seconds per
+    filter combination and page; every call gets its own copies of the units.
+    Pass limit and offset to fetch a single page of units, ordered by ID.
+    """
+    if not LOOKUP_CACHE_ENABLED:
+        return _query_units_by_label_filters(include_label_ids, exclude_label_ids, search_query, limit, offset)
+
+    cache_key = (
+        tuple(sorted(include_label_ids)), tuple(sorted(exclude_label_ids)), search_query or '', limit, offset
+    )
+    with _unit_filter_cache_lock:
+        cached = _unit_filter_cache.get(cache_key)
+        generation = _unit_filter_cache_generation
+    if cached is not None and time.monotonic() - cached[0] < UNIT_FILTER_CACHE_TIMEOUT:
+        return copy.deepcopy(cached[1])
+
+    units = _query_units_by_label_filters(include_label_ids, exclude_label_ids, search_query, limit, offset)
+    with _unit_filter_cache_lock:
+        # Skip results read before a write that cleared the cache in the meantime
+        if generation == _unit_filter_cache_generation:
+            if len(_unit_filter_cache) >= UNIT_FILTER_CACHE_MAX_ENTRIES:
+                _unit_filter_cache.clear()
+            _unit_filter_cache[cache_key] = (time.monotonic(), copy.deepcopy(units))
+    return units
+
+
+def _has_unit_fts(cursor):
+    """Check once per database file whether the unit_fts index exists."""
+    available = _unit_fts_available.get(DATABASE_PATH)
+    if available is None:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'unit_fts'")
+        available = cursor.fetchone() is not None
+        _unit_fts_available[DATABASE_PATH] = available
+    return available
+
+
+def _fts_phrase(search_query):
+    """Quote a search term as a single FTS5 phrase so it is never parsed as query syntax."""
+    return '"' + search_query.replace('"', '""') + '"'
+
+
+def _query_units_by_label_filters(include_label_ids, exclude_label_ids, search_query=None, limit=None, offset=0):
+    """Run the label filter query against the database."""
+    cursor = connect().cursor()
+
+    # Base query
+    query = '''
+        SELECT u.id, u.unit_type, u.name, u.features, u.story_id
+        FROM unit u
+    '''
+    params = []
 
-        # Exclude labels
+    conditions = []
+
+    # Include labels (logical OR) minus exclude labels, as set operations on unit_label
+    if include_label_ids:
+        include_placeholders = ','.join(['?'] * len(include_label_ids))
+        candidates = f'SELECT unit_id FROM unit_label WHERE label_id IN ({include_placeholders})'
+        params.extend(include_label_ids)
         if exclude_label_ids:
             exclude_placeholders = ','.join(['?'] * len(exclude_label_ids))
-            conditions.append(f'''
-                u.id NOT IN (
-                    SELECT unit_id
-                    FROM unit_label
-                    WHERE label_id IN ({exclude_placeholders})
-                )
-            ''')
+            candidates += f' EXCEPT SELECT unit_id FROM unit_label WHERE label_id IN ({exclude_placeholders})'
             params.extend(exclude_label_ids)
-
-        # Search query
-        if search_query:
+        conditions.append(f'u.id IN ({candidates})')
+    elif exclude_label_ids:
+        exclude_placeholders = ','.join(['?'] * len(exclude_label_ids))
+        conditions.append(f'u.id NOT IN (SELECT unit_id FROM unit_label WHERE label_id IN ({exclude_placeholders}))')
+        params.extend(exclude_label_ids)
+
+    # Search query, through the full-text index when the term is long enough for it
+    if search_query:
+        if len(search_query) >= UNIT_FTS_MIN_QUERY_LENGTH and _has_unit_fts(cursor):
+            conditions.append('u.id IN (SELECT rowid FROM unit_fts WHERE unit_fts MATCH ?)')
+            params.append(_fts_phrase(search_query))
+        else:
             conditions.append('''(u.name LIKE ? OR u.unit_type LIKE ? OR u.features LIKE ?)''')
             params.extend([f'%{search_query}%'] * 3)
 
-        if conditions:
-            query += ' WHERE ' + ' AND '.join(conditions)
-
-        query += ' GROUP BY u.id'
-
-        cursor.execute(query, params)
-        units = []
-        for row in cursor.fetchall():
-            unit_id = row[0]
-            unit_type = row[1]
-            name = row[2]
-            features_json = row[3]
-            features = json.loads(features_json) if features_json else {}
-            story_id = row[4]
-            labels = row[5].split(',') if row[5] else []
-
-            unit_class = get_unit_class(unit_type)
-            unit = unit_class(
-                id=unit_id,
-                unit_type=unit_type,
-                name=name,
-                story_id=story_id,
-                features=features
-            )
-            unit.labels = labels  # Attach labels to unit
-            units.append(unit)
-        return units
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    query += ' ORDER BY u.id'
+    if limit is not None:
+        query += ' LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+
+    cursor.execute(query, params)
+    units = [_row_to_unit(row) for row in cursor]
+    _attach_labels(cursor, units)
+    return units
+
+
+def _attach_labels(cursor, units):
+    """Set the labels attribute of each unit to its label names.
+
+    The labels are fetched with one query per LABEL_QUERY_BATCH_SIZE units, which keeps
+    the number of parameters below SQLite's limit.
+    """
+    labels_by_unit = {}
+    unit_ids = [unit.id for unit in units]
+    for start in range(0, len(unit_ids), LABEL_QUERY_BATCH_SIZE):
+        batch = unit_ids[start:start + LABEL_QUERY_BATCH_SIZE]
+        placeholders = ','.join(['?'] * len(batch))
+        cursor.execute(f'''
+            SELECT ul.unit_id, l.name
+            FROM unit_label ul JOIN label l ON l.id = ul.label_id
+            WHERE ul.unit_id IN ({placeholders})
+        ''', batch)
+        for unit_id, label_name in cursor:
+            labels_by_unit.setdefault(unit_id, []).append(label_name)
+    for unit in units:
+        unit.labels = labels_by_unit.get(unit.id, [])
 
 
 def get_labels_by_user(user_email):
     """Retrieve all labels created by the user."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name FROM label WHERE user_email = ?
-        ''', (user_email,))
-        labels = [{'id': row[0], 'name': row[1]} for row in cursor.fetchall()]
-        return labels
+    cursor = connect().cursor()
+    cursor.execute('''
+        SELECT id, name FROM label WHERE user_email = ?
+    ''', (user_email,))
+    labels = [{'id': row[0], 'name': row[1]} for row in cursor]
+    return labels
 
 def get_units_by_labels(label_ids):
     """Retrieve units associated with the given labels."""
@@ -771,101 +1236,53 @@ def get_units_by_labels(label_ids):
         JOIN unit_label ul ON u.id = ul.unit_id
         WHERE ul.label_id IN ({placeholders})
     '''
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute(query, label_ids)
-        units = []
-        for row in cursor.fetchall():
-            unit_id = row[0]
-            unit_type = row[1]
-            name = row[2]
-            features_json = row[3]
-            features = json.loads(features_json) if features_json else {}
-            story_id = row[4]
-
-            unit_class = get_unit_class(unit_type)
-            unit = unit_class(
-                id=unit_id,
-                unit_type=unit_type,
-                name=name,
-                story_id=story_id,
-                features=features
-            )
-            units.append(unit)
-        return units
+    cursor = connect().cursor()
+    cursor.execute(query, label_ids)
+    return [_row_to_unit(row) for row in cursor]
 
-def get_all_units_with_labels():
-    """Retrieve all units along with their labels."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT u.id, u.unit_type, u.name, u.features, u.story_id,
-                   GROUP_CONCAT(l.name) as labels
-            FROM unit u
-            LEFT JOIN unit_label ul ON u.id = ul.unit_id
-            LEFT JOIN label l ON ul.label_id = l.id
-            GROUP BY u.id
-        ''')
-        units = []
-        for row in cursor.fetchall():
-            unit_id = row[0]
-            unit_type = row[1]
-            name = row[2]
-            features_json = row[3]
-            features = json.loads(features_json) if features_json else {}
-            story_id = row[4]
-            labels = row[5].split(',') if row[5] else []
-
-            unit_class = get_unit_class(unit_type)
-            unit = unit_class(
-                id=unit_id,
-                unit_type=unit_type,
-                name=name,
-                story_id=story_id,
-                features=features
-            )
-            unit.labels = labels  # Attach labels to unit
-            units.append(unit)
-        return units
+def get_all_units_with_labels(limit=None, offset=0):
+    """Retrieve all units along with their labels.
+
+    Pass limit and offset to fetch a single page of units, ordered by ID.
+    """
+    query = '''
+        SELECT u.id, u.unit_type, u.name, u.features, u.story_id
+        FROM unit u ORDER BY u.id
+    '''
+    params = []
+    if limit is not None:
+        query += ' LIMIT ? OFFSET ?'
+        params.extend([limit, offset])
+    cursor = connect().cursor()
+    cursor.execute(query, params)
+    units = [_row_to_unit(row) for row in cursor]
+    _attach_labels(cursor, units)
+    return units
 
 def get_unit_by_id(unit_id):
     """Retrieve a unit by its ID."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
-        cursor = conn.cursor()
+    def query():
+        cursor = connect().cursor()
         cursor.execute('''
             SELECT id, unit_type, name, features, story_id
             FROM unit WHERE id = ?
         ''', (unit_id,))
-        row = cursor.fetchone()
-        if row:
-            unit_id = row[0]
-            unit_type = row[1]
-            name = row[2]
-            features_json = row[3]
-            features = json.loads(features_json) if features_json else {}
-            story_id = row[4]
-
-            unit_class = get_unit_class(unit_type)
-            unit = unit_class(
-                id=unit_id,
-                unit_type=unit_type,
-                name=name,
-                story_id=story_id,
-                features=features
-            )
-            return unit
-        else:
-            return None
+        return cursor.fetchone()
+
+    row = _cached_lookup(('unit', 'id', unit_id), query)
+    return _row_to_unit(row) if row else None
 
 
 def delete_unit_from_story(unit):
     """Delete a unit from the database."""
-    with sqlite3.connect(DATABASE_PATH) as conn:
+    with connect() as conn:
         cursor = conn.cursor()
         # Delete the unit from the 'unit' table
         cursor.execute('''
             DELETE FROM unit WHERE id = ?
         ''', (unit.id,))
         conn.commit()
+        clear_unit_filter_cache()
+        _invalidate_lookups('unit')
 
 
@@ -10,11 +10,35 @@ entities like 'Character', 'EventOrScene', 'Item', etc.
 
 from fpdf import FPDF
 from flask_login import UserMixin
+from jinja2 import Environment
+from markupsafe import Markup
 import os
-from .openai_api_call import call_openai
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from .openai_api_call import call_openai, call_openai_stream
+
+# HTML views of stories and units, compiled once. Names and feature values are user
+# text, so everything is escaped.
+_html_environment = Environment(autoescape=True)
+UNIT_HTML_TEMPLATE = _html_environment.from_string(
+    "<h3>{{ unit.unit_type }}: {{ unit.name }}</h3><ul>"
+    "{% for key, value in unit.features.items() %}"
+    "<li><strong>{{ key }}:</strong> {{ value }}</li>"
+    "{% endfor %}</ul>"
+)
+STORY_HTML_TEMPLATE = _html_environment.from_string(
+    "<h1>{{ story.name }}</h1>"
+    "<h2>Setting and Style</h2><p>{{ story.setting_and_style }}</p>"
+    "<h2>Main Challenge</h2><p>{{ story.main_challenge }}</p>"
+    "{% for unit in story.units %}{{ unit.to_html() }}{% endfor %}"
+)
+
+# The per-unit passages of a story are independent API calls, so they are requested concurrently
+fragment_executor = ThreadPoolExecutor(max_workers=8)
 
 class User(UserMixin):
     """User class for authentication."""
+
     def __init__(self, email, username):
         self.email = email
         self.username = username
@@ -38,6 +62,11 @@ class Story:
         units (list): List of units associated with the story.
     """
 
+    __slots__ = (
+        'id', 'name', 'user_email', 'setting_and_style', 'main_challenge',
+        '_undefined_names', '_undefined_names_set', '_units', '_units_by_name',
+    )
+
     def __init__(self, id, name, user_email, setting_and_style, main_challenge):
         """Initialize a new Story instance.
 
@@ -56,49 +85,194 @@ class Story:
         self.undefined_names = []
         self.units = []  # List of Unit objects
 
-    def _generate_prompt(self):
-        """Generate a prompt for the OpenAI API based on the story content."""
-        prompt = f"Write a full story based on the following details:\n\n"
-        prompt += f"Setting and Style:\n{self.setting_and_style}\n\n"
-        prompt += f"Main Challenge:\n{self.main_challenge}\n\n"
-        prompt += "Units:\n"
-        for unit in self.units:
-            prompt += f"{unit.unit_type}: {unit.name}\n"
-            for key, value in unit.features.items():
-                prompt += f"  {key}: {value}\n"
-            prompt += "\n"
-        return prompt
+    @property
+    def units(self):
+        """list: The story's Unit objects.
 
-    def to_text(self, filename='story.txt'):
-        """Generate the story as a text file using OpenAI API."""
+        Assign a new list rather than changing it in place, so the name index
+        used by get_unit is rebuilt.
+        """
+        return self._units
 
-        try:
-            # Prepare the prompt
-            messages = [{
-                "role": "user",
-                "content": self._generate_prompt()
-            }]
+    @units.setter
+    def units(self, units):
+        self._units = units
+        self._units_by_name = None
+
+    def get_unit(self, unit_name):
+        """Get a unit of the story by name.
+
+        Args:
+            unit_name (str): Name of the unit.
+
+        Returns:
+            Unit or None: The unit with the given name, or None if there is none.
+        """
+        if self._units_by_name is None:
+            self._units_by_name = {unit.name: unit for unit in self._units}
+        return self._units_by_name.get(unit_name)
+
+    @property
+    def undefined_names(self):
+        """list: Undefined names in order of first use.
+
+        Use add_undefined_name and remove_undefined_name to change it, so the
+        set used for membership checks stays in sync.
+        """
+        return self._undefined_names
+
+    @undefined_names.setter
+    def undefined_names(self, names):
+        self._undefined_names = list(names)
+        self._undefined_names_set = set(self._undefined_names)
+
+    def add_undefined_name(self, name):
+        """Add a name to the undefined names unless it is already there.
+
+        Args:
+            name (str): The undefined name.
+
+        Returns:
+            bool: True if the name was added.
+        """
+        if name in self._undefined_names_set:
+            return False
+        self._undefined_names.append(name)
+        self._undefined_names_set.add(name)
+        return True
+
+    def remove_undefined_name(self, name):
+        """Remove a name from the undefined names if present.
+
+        Args:
+            name (str): The name that is no longer undefined.
+
+        Returns:
+            bool: True if the name was removed.
+        """
+        if name not in self._undefined_names_set:
+            return False
+        self._undefined_names.remove(name)
+        self._undefined_names_set.discard(name)
+        return True
+
+    def _fragment_preamble(self):
+        """Generate the instructions shared by the passage prompts of all units.
+
+        It is sent first and is identical for every unit of the story, so the API can
+        reuse its cached prompt prefix across the passage requests.
+        """
+        return (
+            "Write a short narrative passage about the story element given by the user. "
+            "It will be combined with the passages about the other elements into a full story.\n\n"
+            f"Setting and Style:\n{self.setting_and_style}\n\n"
+            f"Main Challenge:\n{self.main_challenge}\n"
+        )
+
+    def _prompt_units(self):
+        """Return the units in the order they appear in prompts, by type and name."""
+        return sorted(self.units, key=lambda unit: (unit.unit_type, unit.name))
+
+    def _unit_prompt(self, unit):
+        """Generate the prompt part that describes a single unit."""
+        return "Element:\n" + unit.to_text()
+
+    def _stitch_prompt(self, units, fragments):
+        """Generate a prompt that combines the units' passages into the full story."""
+        parts = [
+            "Write a full story based on the following details:\n\n",
+            f"Setting and Style:\n{self.setting_and_style}\n\n",
+            f"Main Challenge:\n{self.main_challenge}\n\n",
+            "Passages about the story elements:\n\n",
+        ]
+        parts.extend(
+            f"{unit.unit_type}: {unit.name}\n{fragment}\n\n"
+            for unit, fragment in zip(units, fragments)
+        )
+        return ''.join(parts)
+
+    def _unit_fragment(self, unit):
+        """Generate the narrative passage about a unit.
+
+        The passage only depends on the setting, the main challenge and the unit itself,
+        so call_openai answers it from its cache until one of these changes.
+        """
+        messages = [
+            {"role": "system", "content": self._fragment_preamble()},
+            {"role": "user", "content": self._unit_prompt(unit)},
+        ]
+        return call_openai(messages=messages, model="gpt-4o-mini", use_cache=True)
+
+    def generate_text_stream(self):
+        """Generate the full story text using OpenAI API, yielding it as it is written.
+
+        A passage is written for each unit first, then they are combined into the story,
+        so editing one unit only asks for that unit's passage again. The passages are
+        requested concurrently; the combined story is streamed.
+
+        Yields:
+            str: Consecutive parts of the generated story.
+        """
+        units = self._prompt_units()
+        fragments = list(fragment_executor.map(self._unit_fragment, units))
+
+        # Prepare the prompt; o1-mini takes no system message, but the story details
+        # still come before the passages so the prompt starts the same on every run
+        messages = [{
+            "role": "user",
+            "content": self._stitch_prompt(units, fragments)
+        }]
 
-            story_text = call_openai(messages=messages, model="o1-mini") # , model="gpt-4o-mini"
+        yield from call_openai_stream(messages=messages, model="o1-mini") # , model="gpt-4o-mini"
 
-            # Write the story to the text file
-            with open(filename, 'w', encoding='utf-8') as file:
-                file.write(story_text)
+    def to_text(self, filename='story.txt'):
+        """Generate the story as a text file using OpenAI API.
+
+        Args:
+            filename (str or file-like, optional): Filename for the text file, or a
+                writable text stream to write the story to. Defaults to 'story.txt'.
+        """
+
+        try:
+            # Write the story to the given stream or text file as it is generated
+            if hasattr(filename, 'write'):
+                for chunk in self.generate_text_stream():
+                    filename.write(chunk)
+            else:
+                with open(filename, 'w', encoding='utf-8') as file:
+                    for chunk in self.generate_text_stream():
+                        file.write(chunk)
 
         except Exception as e:
             print(f"Error generating story text: {e}")
             raise
 
+    def reference_index(self, units=None):
+        """Index the names that the story's units refer to.
+
+        Args:
+            units (list of Unit, optional): The units to index. Defaults to all units
+                of the story.
+
+        Returns:
+            dict: Maps each referenced name to a list of (unit, feature name) pairs
+                whose list or text feature contains it.
+        """
+        index = {}
+        for unit in self.units if units is None else units:
+            for feature_name, expected_type in type(unit).reference_features:
+                value = unit.features.get(feature_name)
+                if expected_type == list and isinstance(value, list):
+                    for name in dict.fromkeys(value):
+                        index.setdefault(name, []).append((unit, feature_name))
+                elif expected_type == str and isinstance(value, str):
+                    index.setdefault(value, []).append((unit, feature_name))
+        return index
+
     # --- Serialization Methods ---
     def to_text_list(self):
         """Return a textual list of units in the story."""
-        text = ""
-        for unit in self.units:
-            text += f"{unit.unit_type}: {unit.name}\n"
-            for key, value in unit.features.items():
-                text += f"  {key}: {value}\n"
-            text += "\n"
-        return text
+        return ''.join(unit.to_text() + "\n" for unit in self._prompt_units())
 
     def to_json(self):
         """Serialize the story to a JSON-friendly dictionary.
@@ -117,22 +291,21 @@ class Story:
         """Convert the story to an HTML representation.
 
         Returns:
-            str: HTML content representing the story.
+            Markup: Escaped HTML content representing the story.
         """
-        html_content = f"<h1>{self.name}</h1>"
-        html_content += f"<h2>Setting and Style</h2><p>{self.setting_and_style}</p>"
-        html_content += f"<h2>Main Challenge</h2><p>{self.main_challenge}</p>"
-        for unit in self.units:
-            html_content += unit.to_html()
-        return html_content
+        return Markup(STORY_HTML_TEMPLATE.render(story=self))
 
-    def to_pdf(self, filename='story.pdf'):
-        """Export the story to a PDF file.
+    def to_pdf_bytes(self):
+        """Render the story as a PDF document in memory.
 
-        Args:
-            filename (str, optional): Filename for the PDF. Defaults to 'story.pdf'.
+        Returns:
+            bytes: The PDF file content.
         """
+        # FPDF 1.x returns the document as a latin-1 string for dest='S'
+        return self._build_pdf().output(dest='S').encode('latin-1')
 
+    def _build_pdf(self):
+        """Lay out the story in a new FPDF document."""
         pdf = FPDF()
         pdf.add_page()
         pdf.set_auto_page_break(auto=True, margin=15)
@@ -145,11 +318,12 @@ class Story:
             pdf.set_font('Arial', 'B', 14)
             pdf.cell(0, 10, f"{unit.unit_type}: {unit.name}", ln=True)
             pdf.set_font('Arial', '', 12)
-            for key, value in unit.features.items():
-                pdf.multi_cell(0, 10, f"{key}: {value}")
-                pdf.ln(1)
+            # All features of a unit go into one multi_cell, one line per feature
+            body = "\n".join(f"{key}: {value}" for key, value in unit.features.items())
+            if body:
+                pdf.multi_cell(0, 10, body)
             pdf.ln(5)
-        pdf.output(filename)
+        return pdf
 
     # --- Magic Methods ---
 
@@ -165,10 +339,10 @@ class Story:
         Raises:
             KeyError: If no unit with the given name is found.
         """
-        for unit in self.units:
-            if unit.name == unit_name:
-                return unit
-        raise KeyError(f"No unit named '{unit_name}' found.")
+        unit = self.get_unit(unit_name)
+        if unit is None:
+            raise KeyError(f"No unit named '{unit_name}' found.")
+        return unit
 
     def __len__(self):
         """Get the number of units in the story.
@@ -187,6 +361,22 @@ class Story:
         return iter(self.units)
 
 
+# Filled in by Unit.__init_subclass__
+UNIT_TYPE_TO_CLASS = {}
+
+
+def prompt_value(value):
+    """Format a feature value for a prompt, independent of incidental differences.
+
+    Whitespace in text is collapsed and lists of names are deduplicated and sorted.
+    """
+    if isinstance(value, str):
+        return ' '.join(value.split())
+    if isinstance(value, list):
+        return ', '.join(sorted(dict.fromkeys(' '.join(str(item).split()) for item in value)))
+    return value
+
+
 class Unit:
     """Base Class representing a Unit in the Story.
 
@@ -196,9 +386,27 @@ class Unit:
         name (str): Name of the unit.
         story_id (int): ID of the associated story.
         features (dict): Dictionary of unit's features.
+        labels (list): Names of the unit's labels, only set by the loaders that fetch them.
     """
 
-    base_feature_schema = {'name': str}
+    # Stories can hold many units, so they do without a per-instance __dict__
+    __slots__ = ('id', 'unit_type', 'name', 'story_id', 'features', 'labels')
+
+    base_feature_schema = MappingProxyType({'name': str})
+    feature_schema = base_feature_schema
+    # The (feature name, type) pairs of the list and text features that can refer to other units
+    reference_features = ()
+
+    def __init_subclass__(cls, **kwargs):
+        """Make the subclass's feature schema read-only and register it for get_unit_class."""
+        super().__init_subclass__(**kwargs)
+        cls.feature_schema = MappingProxyType(dict(cls.feature_schema))
+        cls.reference_features = tuple(
+            (feature_name, expected_type)
+            for feature_name, expected_type in cls.feature_schema.items()
+            if feature_name != 'name' and expected_type in (list, str)
+        )
+        UNIT_TYPE_TO_CLASS[cls.__name__] = cls
 
     def __init__(self, unit_type, name, story_id, features, id=None):
         """Initialize a new Unit instance.
@@ -230,18 +438,31 @@ class Unit:
             'features': self.features,
         }
 
+    def to_text(self):
+        """Convert the unit to the plain text block used in prompts.
+
+        The text is canonical: features follow the schema order, names in lists are
+        sorted and whitespace is collapsed. Units with the same content therefore
+        produce the same prompt and share cached replies.
+
+        Returns:
+            str: The unit type and name, then one indented line per feature.
+        """
+        schema = type(self).feature_schema
+        keys = [key for key in schema if key in self.features]
+        keys.extend(sorted(key for key in self.features if key not in schema))
+        return (
+            f"{self.unit_type}: {self.name}\n"
+            + ''.join(f"  {key}: {prompt_value(self.features[key])}\n" for key in keys)
+        )
+
     def to_html(self):
         """Convert the unit to an HTML representation.
 
         Returns:
-            str: HTML content representing the unit.
+            Markup: Escaped HTML content representing the unit.
         """
-        html_content = f"<h3>{self.unit_type}: {self.name}</h3>"
-        html_content += "<ul>"
-        for key, value in self.features.items():
-            html_content += f"<li><strong>{key}:</strong> {value}</li>"
-        html_content += "</ul>"
-        return html_content
+        return Markup(UNIT_HTML_TEMPLATE.render(unit=self))
 
 
 # Subclasses of Unit
@@ -250,8 +471,10 @@ class EventOrScene(Unit):
     """Class representing an Event or Scene in the Story.
 
     Attributes:
-        feature_schema (dict): Schema defining the features and their data types.
+        feature_schema (mappingproxy): Read-only schema defining the features and their data types.
     """
+    __slots__ = ()  # no attributes beyond those of Unit
+
     # Extend the base feature schema with specific fields
     feature_schema = {**Unit.base_feature_schema, **{
         'Which people are involved?': list,
@@ -275,6 +498,8 @@ class EventOrScene(Unit):
 
 class Secret(Unit):
     """Class representing a Secret in the Story."""
+    __slots__ = ()  # no attributes beyond those of Unit
+
     feature_schema = {**Unit.base_feature_schema, **{
         'What is the secret?': str,
         'Who knows of it?': list,
@@ -287,6 +512,8 @@ class Secret(Unit):
 
 class Item(Unit):
     """Class representing an Item in the Story."""
+    __slots__ = ()  # no attributes beyond those of Unit
+
     feature_schema = {**Unit.base_feature_schema, **{
         'Who owns this?': list,
         'Worth': float,
@@ -297,6 +524,8 @@ class Item(Unit):
 
 class Beast(Unit):
     """Class representing a Beast in the Story."""
+    __slots__ = ()  # no attributes beyond those of Unit
+
     feature_schema = {**Unit.base_feature_schema, **{
         'Which race is this beast?': str,
         'Where could it be?': list,
@@ -307,6 +536,8 @@ class Beast(Unit):
 
 class Grouping(Unit):
     """Class representing a Group in the Story."""
+    __slots__ = ()  # no attributes beyond those of Unit
+
     feature_schema = {**Unit.base_feature_schema, **{
         'Who is part of the group?': list,
         'Reason for solidarity': str,
@@ -316,6 +547,8 @@ class Grouping(Unit):
 
 class Motivation(Unit):
     """Class representing a Motivation in the Story."""
+    __slots__ = ()  # no attributes beyond those of Unit
+
     feature_schema = {**Unit.base_feature_schema, **{
         'Who is motivated?': list,
         'What is the motivation for?': str,
@@ -330,6 +563,8 @@ class Motivation(Unit):
 
 class Place(Unit):
     """Class representing a Place in the Story."""
+    __slots__ = ()  # no attributes beyond those of Unit
+
     feature_schema = {**Unit.base_feature_schema, **{
         'Where is it?': str,
         'Environmental conditions': str,
@@ -353,6 +588,8 @@ class Place(Unit):
 
 class TransportationInfrastructure(Unit):
     """Class representing Transportation Infrastructure in the Story."""
+    __slots__ = ()  # no attributes beyond those of Unit
+
     feature_schema = {**Unit.base_feature_schema, **{
         'Connecting places': list,
         'Usage frequency': float,
@@ -370,6 +607,8 @@ class TransportationInfrastructure(Unit):
 
 class Character(Unit):
     """Class representing a Character in the Story."""
+    __slots__ = ()  # no attributes beyond those of Unit
+
     feature_schema = {**Unit.base_feature_schema, **{
         'Is this a player character?': bool,
         'Skills or talents': str,
@@ -382,18 +621,5 @@ class Character(Unit):
     }}
 
 
-# Mapping of unit_type to class
-UNIT_TYPE_TO_CLASS = {
-    'EventOrScene': EventOrScene,
-    'Secret': Secret,
-    'Item': Item,
-    'Beast': Beast,
-    'Grouping': Grouping,
-    'Motivation': Motivation,
-    'Place': Place,
-    'TransportationInfrastructure': TransportationInfrastructure,
-    'Character': Character,
-}
-
 def get_unit_class(unit_type):
     return UNIT_TYPE_TO_CLASS.get(unit_type, Unit)
\ No newline at end of file
@@ -1,7 +1,40 @@
 import openai
+import httpx
+import hashlib
+import json
+import re
+import threading
 import time
+from collections import OrderedDict
 
-openai_client = openai.OpenAI()
+# A reply wrapped in a Markdown code fence, with or without a json language tag
+CODE_FENCE_PATTERN = re.compile(r'^\s*```(?:json)?[ \t]*\n?(.*?)\n?```\s*$', re.DOTALL | re.IGNORECASE)
+
+OPENAI_MAX_CONNECTIONS = 64
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = 32
+
+# Every API call is made while a user waits on the request (the background PDF
+# prerender makes none), so failures are retried only a couple of times before the
+# error is reported.
+OPENAI_MAX_RETRIES = 2
+
+# Concurrent requests (e.g. the passages of a story) can hit the rate limit; the client
+# retries those with exponential backoff. One client serves the whole process and its
+# pool keeps connections open, so parallel requests don't each pay for a TLS handshake.
+openai_client = openai.OpenAI(
+    max_retries=OPENAI_MAX_RETRIES,
+    http_client=openai.DefaultHttpxClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+    ),
+)
+
+# Replies that arrive in one piece from the quick models (unit passages, prefilled
+# features) get a shorter timeout than the client's default. Streamed story calls keep
+# the default, as reasoning models send nothing while they think.
+QUICK_REPLY_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
 
 
 '''
@@ -12,17 +45,118 @@ if not openai_api_key:
 openai.api_key = openai_api_key
 '''
 
-def call_openai(messages, model="gpt-4o-mini"):
+# Replies to recently sent prompts, keyed by a hash of the model and messages. Only
+# callers that pass use_cache=True use it: calls whose reply should not change while the
+# prompt stays the same (e.g. unit passages). Generation the user asks for again gets a
+# fresh reply.
+RESPONSE_CACHE_TIMEOUT = 24 * 60 * 60  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 256
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def response_cache_key(messages, model):
+    """Hash the model and prompt messages of a request.
+
+    Runs of whitespace in the message contents are collapsed first, so prompts that
+    differ only in spacing or line breaks share a cache entry.
+    """
+    normalized_messages = [
+        {**message, 'content': ' '.join(message['content'].split())}
+        if isinstance(message.get('content'), str) else message
+        for message in messages
+    ]
+    request_json = json.dumps({'model': model, 'messages': normalized_messages}, sort_keys=True)
+    return hashlib.sha256(request_json.encode('utf-8')).hexdigest()
+
+
+def get_cached_response(cache_key):
+    """Return the cached reply for a request, or None if there is no fresh one."""
+    with _response_cache_lock:
+        cached = _response_cache.get(cache_key)
+        if cached is None:
+            return None
+        stored_at, assistant_reply = cached
+        if time.monotonic() - stored_at > RESPONSE_CACHE_TIMEOUT:
+            del _response_cache[cache_key]
+            return None
+        _response_cache.move_to_end(cache_key)
+        return assistant_reply
+
+
+def store_response(cache_key, assistant_reply):
+    """Cache the reply for a request."""
+    with _response_cache_lock:
+        _response_cache[cache_key] = (time.monotonic(), assistant_reply)
+        _response_cache.move_to_end(cache_key)
+        while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last=False)
+
+
+def call_openai(messages, model="gpt-4o-mini", use_cache=False, timeout=QUICK_REPLY_TIMEOUT):
+    if use_cache:
+        cache_key = response_cache_key(messages, model)
+        assistant_reply = get_cached_response(cache_key)
+        if assistant_reply is not None:
+            return assistant_reply
+
     t = time.time()
     response = openai_client.chat.completions.create(
         model=model,
-        messages=messages
+        messages=messages,
+        timeout=timeout
     )
     print(f'API request took {time.time() - t}')
 
     # Parse the assistant's reply
     assistant_reply = response.choices[0].message.content
-    if assistant_reply.startswith('```json') and assistant_reply.endswith('```'):
-        assistant_reply = assistant_reply[8:-4]
+    fence_match = CODE_FENCE_PATTERN.match(assistant_reply)
+    if fence_match:
+        assistant_reply = fence_match.group(1)
 
+    if use_cache:
+        store_response(cache_key, assistant_reply)
     return assistant_reply
+
+
+def call_openai_stream(messages, model="gpt-4o-mini", use_cache=False):
+    """Request a reply and yield its text piece by piece as it is generated.
+
+    Callers can pass the text on before the whole reply is ready. A cached reply is
+    yielded in one piece. Unlike call_openai, the reply is passed on unchanged, so it
+    is meant for prose rather than JSON.
+
+    Args:
+        messages (list): The chat messages to send.
+        model (str, optional): The model to use. Defaults to "gpt-4o-mini".
+        use_cache (bool, optional): Whether to reuse and cache replies. Defaults to False.
+
+    Yields:
+        str: Consecutive parts of the reply.
+    """
+    if use_cache:
+        cache_key = response_cache_key(messages, model)
+        assistant_reply = get_cached_response(cache_key)
+        if assistant_reply is not None:
+            yield assistant_reply
+            return
+
+    t = time.time()
+    stream = openai_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True
+    )
+    parts = []
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.content
+        if content:
+            parts.append(content)
+            yield content
+    print(f'API request took {time.time() - t}')
+
+    # Only a reply that was read to the end is cached
+    if use_cache:
+        store_response(cache_key, ''.join(parts))